@@ -1,17 +1,34 @@
 from sys import argv
+from types import MappingProxyType
 from typing import Any
 
 import jinja2
 import sentry_sdk
 from aiohttp import ClientSession, web
-from aiohttp_apispec import setup_aiohttp_apispec, validation_middleware
+from aiohttp_apispec import setup_aiohttp_apispec
 from asyncpg import create_pool
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 from yaml import safe_load
 
 from app import blueprints, templating
-from app.routing import register_blueprint, url_for
-from app.utils.auth import verify_user
+from app.models.shortener import MAX_BODY_SIZE
+from app.routing import RadixRouter, register_blueprint, url_for
+from app.utils.analytics import setup_click_analytics
+from app.utils.clicks import setup_click_buffer
+from app.utils.compression import setup_compression
+from app.utils.notes import setup_note_keys
+from app.utils.notify import LISTENER_KEY, setup_listener
+from app.utils.passwords import setup_password_hasher
+from app.utils.sessions import setup_session_cache
+from app.utils.shortener import (
+    setup_alias_filter,
+    setup_alias_pool,
+    setup_short_url_cache,
+)
+from app.utils.signed_sessions import setup_signed_sessions
+from app.utils.static import setup_static, static_url
+from app.utils.sweeper import setup_session_sweeper
+from app.utils.user_agents import setup_user_agent_cache
 
 sentry_sdk.init(
     dsn="https://c51ee48c5ae341ba9a16d57657fc89b0@o1007379.ingest.sentry.io/6237979",
@@ -24,44 +41,12 @@ def truncate(text: str, limit: int) -> str:
     return f"{text[:limit - 3]}..." if len(text) > limit else text
 
 
-async def handle_errors(request: web.Request, error: web.HTTPException) -> web.Response:
-    if not str(request.rel_url).startswith("/api") and error.status in {403, 404, 500}:
-        return await templating.render_template(f"errors/{error.status}", request, status=error.status)
-
-    raise error
-
-
-@web.middleware
-async def authentication_middleware(request: web.Request, handler):
-    function = handler
-    if hasattr(handler, request.method.lower()):
-        function = getattr(handler, request.method.lower())
-
-    if hasattr(function, "requires_auth"):
-        try:
-            await verify_user(
-                request,
-                admin=function.auth["admin"],
-                redirect=function.auth["redirect"],
-                scopes=function.auth["scopes"],
-            )
-        except web.HTTPException as error:
-            return await handle_errors(request, error)
-
-    return await handler(request)
-
-
-@web.middleware
-async def exception_middleware(request: web.Request, handler):
-    try:
-        return await handler(request)
-    except web.HTTPException as error:  # handle exceptions here
-        return await handle_errors(request, error)
-
-
 @jinja2.pass_context
-def __url_for(context, *args, **kwargs) -> str:
-    return url_for(context["app"], *args, **kwargs)
+def __url_for(context, name: str, *args, **kwargs) -> str:
+    if name == "static":
+        # built assets have a hash in their name, the manifest knows it
+        return static_url(context["app"], kwargs["filename"])
+    return url_for(context["app"], name, *args, **kwargs)
 
 
 async def custom_processor(request: web.Request) -> dict[str, Any]:
@@ -72,7 +57,8 @@ async def custom_processor(request: web.Request) -> dict[str, Any]:
 
 
 async def app_factory():
-    app = web.Application(middlewares=[authentication_middleware, validation_middleware, exception_middleware])
+    # every route's handler comes with the auth, validation and error handling it needs, see compile_handler
+    app = web.Application(router=RadixRouter(), client_max_size=MAX_BODY_SIZE)
 
     _blueprints = (
         blueprints.auth.bp,
@@ -81,14 +67,13 @@ async def app_factory():
         blueprints.dashboard.notes.bp,
         blueprints.admin.users.bp,
         blueprints.admin.application.bp,
-        blueprints.base.bp,  # this has to go last
+        blueprints.api.shortener.bp,
+        blueprints.base.bp,  # /{alias} only gets the paths nothing else matches, wherever this goes
     )
 
     for _blueprint in _blueprints:
         register_blueprint(app, _blueprint)
 
-    app.router.add_static("/static", "dist")
-
     setup_aiohttp_apispec(
         app=app,
         title="Documentation",
@@ -98,16 +83,6 @@ async def app_factory():
         in_place=False,
     )
 
-    templating.setup(
-        app,
-        global_functions={
-            "len": len,
-            "truncate": truncate,
-            "url_for": __url_for,
-        },
-        context_processors=[custom_processor],
-    )
-
     app["dev"] = "adev" in argv[0]
     with open("config.yml", encoding="utf-8") as config_file:
         loaded = safe_load(config_file)
@@ -119,26 +94,62 @@ async def app_factory():
 
     app["config"] = config
 
+    setup_static(app)
+    setup_compression(app)
+
+    # outside dev templates only change on deploy, so they're loaded precompiled and never checked for changes
+    templates_config = app["config"].get("templates", {})
+    templating.setup(
+        app,
+        loader=templating.default_loader(precompiled=templates_config.get("precompiled", not app["dev"])),
+        auto_reload=templates_config.get("auto_reload", app["dev"]),
+        global_functions={
+            "len": len,
+            "truncate": truncate,
+            "url_for": __url_for,
+        },
+        context_processors=[custom_processor],
+    )
+
+    # before anything else is set up so the worker processes are forked from a clean process
+    await setup_password_hasher(app)
+
     app["db"] = await create_pool(dsn=app["config"]["postgres_dsn"])
     app["session"] = ClientSession()
 
+    await setup_listener(app)
+    await setup_session_cache(app)
+    await setup_signed_sessions(app)
+    setup_session_sweeper(app)
+    setup_user_agent_cache(app)
+    await templating.setup_fragment_cache(app)
+    await setup_short_url_cache(app)
+    await setup_alias_filter(app)
+    await setup_alias_pool(app)
+    setup_note_keys(app)
+    setup_click_buffer(app)
+    await setup_click_analytics(app)
+
+    headers = {
+        "Permissions-Policy": "accelerometer=(), ambient-light-sensor=(), autoplay=(), battery=(), camera=(), cross-origin-isolated=(self), display-capture=(), document-domain=(), encrypted-media=(self), execution-while-not-rendered=(), execution-while-out-of-viewport=(), fullscreen=(self), geolocation=(), gyroscope=(), keyboard-map=*, magnetometer=(), microphone=(), midi=(), navigation-override=(), payment=(), picture-in-picture=(self), publickey-credentials-get=(self), screen-wake-lock=(self), sync-xhr=*, usb=(), web-share=(), xr-spatial-tracking=(), clipboard-read=(), clipboard-write=(self), gamepad=(), speaker-selection=(self)",  # pylint: disable=line-too-long
+        "X-Frame-Options": "DENY",
+        "X-Content-Type-Options": "nosniff",
+        "Referrer-Policy": "no-referrer",
+        "Content-Security-Policy": "default-src 'self' meizuflux.com *.meizuflux.com; style-src 'self' cdnjs.cloudflare.com",  # pylint: disable=line-too-long
+    }
+    if app["dev"] is False:
+        headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
+    # built once, the same headers go on every response
+    security_headers = MappingProxyType(headers)
+
     async def security_signal(_: web.Request, response: web.Response) -> None:
-        response.headers[
-            "Permissions-Policy"
-        ] = "accelerometer=(), ambient-light-sensor=(), autoplay=(), battery=(), camera=(), cross-origin-isolated=(self), display-capture=(), document-domain=(), encrypted-media=(self), execution-while-not-rendered=(), execution-while-out-of-viewport=(), fullscreen=(self), geolocation=(), gyroscope=(), keyboard-map=*, magnetometer=(), microphone=(), midi=(), navigation-override=(), payment=(), picture-in-picture=(self), publickey-credentials-get=(self), screen-wake-lock=(self), sync-xhr=*, usb=(), web-share=(), xr-spatial-tracking=(), clipboard-read=(), clipboard-write=(self), gamepad=(), speaker-selection=(self)"  # pylint: disable=line-too-long
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["Referrer-Policy"] = "no-referrer"
-        response.headers[
-            "Content-Security-Policy"
-        ] = "default-src 'self' meizuflux.com *.meizuflux.com; style-src 'self' cdnjs.cloudflare.com"
-        if app["dev"] is False:
-            response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
+        response.headers.update(security_headers)
 
     app.on_response_prepare.append(security_signal)
 
     async def close(_app: web.Application) -> None:
         await _app["session"].close()
+        await _app[LISTENER_KEY].close()
         await _app["db"].close()
 
     app.on_cleanup.append(close)
@@ -1,3 +1,4 @@
 from . import auth, base
 from .admin import application, users
+from .api import shortener as api_shortener
 from .dashboard import notes, settings, shortener
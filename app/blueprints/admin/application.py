@@ -9,6 +9,8 @@ from aiohttp import web
 
 from app.routing import Blueprint
 from app.templating import render_template
+from app.utils.cache import CACHES_KEY
+from app.utils.compression import COMPRESSOR_KEY
 from app.utils.db import (
     get_db,
     select_total_sessions_count,
@@ -16,6 +18,9 @@ from app.utils.db import (
     select_total_unique_sessions_count,
     select_total_users_count,
 )
+from app.utils.shortener import ALIAS_FILTER_KEY
+from app.utils.signed_sessions import SESSION_SIGNER_KEY
+from app.utils.sweeper import SESSION_SWEEPER_KEY
 
 FILES = LINES = CHARACTERS = CLASSES = FUNCTIONS = COROUTINES = COMMENTS = 0
 for f in Path("./").rglob("*.*"):
@@ -92,6 +97,13 @@ async def index(request: web.Request) -> web.Response:
             "unique_session_count": await select_total_unique_sessions_count(conn),
         }
 
+    ctx["caches"] = {name: cache.stats() for name, cache in request.app.get(CACHES_KEY, {}).items()}
+    ctx["alias_filter"] = request.app[ALIAS_FILTER_KEY].stats()
+    ctx["session_sweeper"] = request.app[SESSION_SWEEPER_KEY].stats()
+    ctx["compression"] = request.app[COMPRESSOR_KEY].stats()
+    if SESSION_SIGNER_KEY in request.app:
+        ctx["signed_sessions"] = request.app[SESSION_SIGNER_KEY].stats()
+
     ctx["cpu"] = {
         "percentage": "%, ".join([str(i) for i in psutil.cpu_percent(percpu=True)]),
         "cores": psutil.cpu_count(),
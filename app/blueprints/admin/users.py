@@ -1,12 +1,14 @@
 from aiohttp import web
 from aiohttp_apispec import match_info_schema, querystring_schema
 
-from app.models.auth import UserIDSchema, UsersFilterSchema
+from app.models.auth import USERS_SORT_COLUMNS, UserIDSchema, UsersFilterSchema
 from app.routing import Blueprint
-from app.templating import render_template
+from app.templating import render_template, stream_template
 from app.utils import Status
 from app.utils.auth import create_user, edit_user, requires_auth
 from app.utils.db import delete_user, get_db, select_user, select_users
+from app.utils.pagination import build_page, read_cursor
+from app.utils.sessions import forget_user
 from app.utils.time import get_amount_and_unit
 
 bp = Blueprint("/admin/users", name="users")
@@ -15,13 +17,25 @@ bp = Blueprint("/admin/users", name="users")
 @bp.get("", name="index")
 @querystring_schema(UsersFilterSchema())
 @requires_auth(admin=True)
-async def list_users(request: web.Request) -> web.Response:
+async def list_users(request: web.Request) -> web.StreamResponse:
     direction = request["querystring"].get("direction", "desc")
     sortby = request["querystring"].get("sortby", "joined")
+    cursor, backwards = read_cursor(
+        request["querystring"], sortby=sortby, direction=direction, columns=USERS_SORT_COLUMNS, tiebreaker="id"
+    )
 
-    users = await select_users(get_db(request), sortby=sortby, direction=direction)
-    return await render_template(
-        "admin/users/index", request, {"users": users, "sortby": sortby, "direction": direction}
+    users = await select_users(get_db(request), sortby=sortby, direction=direction, cursor=cursor, backwards=backwards)
+    page = build_page(users, sortby=sortby, direction=direction, tiebreaker="id", cursor=cursor, backwards=backwards)
+    return await stream_template(
+        "admin/users/index",
+        request,
+        {
+            "users": page.rows,
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
+            "sortby": sortby,
+            "direction": direction,
+        },
     )
 
 
@@ -88,6 +102,7 @@ async def delete_user_(request: web.Request) -> web.Response:
 
     if request.method == "POST":
         await delete_user(get_db(request), user_id=user_id)
+        forget_user(request.app, user_id)
 
         return web.HTTPFound("/admin/users")
 
@@ -0,0 +1,97 @@
+from aiohttp import web
+from aiohttp_apispec import match_info_schema
+from asyncpg import UniqueViolationError
+from marshmallow import ValidationError
+
+from app.models.shortener import (
+    ShortenerAliasSchema,
+    ShortenerBulkCreateSchema,
+    ShortenerCreateSchema,
+)
+from app.routing import Blueprint
+from app.utils.auth import requires_auth
+from app.utils.db import delete_short_url, get_db, insert_short_url, select_short_url
+from app.utils.forms import parser
+from app.utils.responses import json_response
+from app.utils.shortener import create_short_url, create_short_urls, remember_alias
+
+bp = Blueprint("/api/shortener", name="api_shortener")
+
+
+def short_url_json(request: web.Request, alias: str, destination: str) -> dict[str, str]:
+    return {"alias": alias, "destination": destination, "url": f"https://{request.app['config']['domain']}/{alias}"}
+
+
+def validation_error(error: ValidationError) -> web.Response:
+    return json_response({"message": "Invalid request body", "errors": error.normalized_messages()}, status=400)
+
+
+@bp.post("", name="create")
+@requires_auth(redirect=False, scopes=["id"])
+async def create(request: web.Request) -> web.Response:
+    try:
+        args = await parser.parse(ShortenerCreateSchema(), request, locations=["json"])
+    except ValidationError as error:
+        return validation_error(error)
+
+    alias = args.get("alias")
+    destination = args["destination"]
+    if alias is None or alias == "":
+        alias = await create_short_url(request.app, owner=request["user"]["id"], destination=destination)
+    else:
+        try:
+            await insert_short_url(get_db(request), owner=request["user"]["id"], alias=alias, destination=destination)
+            remember_alias(request.app, alias)
+        except UniqueViolationError:
+            return json_response({"message": "A shortened URL with this alias already exists"}, status=409)
+
+    return json_response(short_url_json(request, alias, destination), status=201)
+
+
+@bp.post("/bulk", name="bulk_create")
+@requires_auth(redirect=False, scopes=["id"])
+async def bulk_create(request: web.Request) -> web.Response:
+    """Up to 1,000 destinations of at most 2,048 characters each, in a body of at most 4 MiB"""
+    try:
+        args = await parser.parse(ShortenerBulkCreateSchema(), request, locations=["json"])
+    except ValidationError as error:
+        return validation_error(error)
+
+    destinations = args["destinations"]
+    aliases = await create_short_urls(request.app, owner=request["user"]["id"], destinations=destinations)
+
+    return json_response(
+        {"urls": [short_url_json(request, alias, destination) for alias, destination in zip(aliases, destinations)]},
+        status=201,
+    )
+
+
+@bp.get("/{alias}", name="view")
+@requires_auth(redirect=False, scopes=["id"])
+@match_info_schema(ShortenerAliasSchema())
+async def view(request: web.Request) -> web.Response:
+    short_url = await select_short_url(get_db(request), alias=request["match_info"]["alias"])
+    if short_url is None or short_url["owner"] != request["user"]["id"]:
+        return json_response({"message": "Could not locate short URL"}, status=404)
+
+    return json_response(
+        {
+            **short_url_json(request, short_url["alias"], short_url["destination"]),
+            "clicks": short_url["clicks"],
+            "creation_date": short_url["creation_date"],
+        }
+    )
+
+
+@bp.delete("/{alias}", name="delete")
+@requires_auth(redirect=False, scopes=["id"])
+@match_info_schema(ShortenerAliasSchema())
+async def delete(request: web.Request) -> web.Response:
+    alias = request["match_info"]["alias"]
+
+    short_url = await select_short_url(get_db(request), alias=alias)
+    if short_url is None or short_url["owner"] != request["user"]["id"]:
+        return json_response({"message": "Could not locate short URL"}, status=404)
+
+    await delete_short_url(get_db(request), alias=alias)
+    return web.Response(status=204)
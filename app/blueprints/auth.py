@@ -3,33 +3,40 @@ from uuid import UUID
 from aiohttp import web
 from aiohttp_apispec import match_info_schema, querystring_schema
 from marshmallow import Schema, ValidationError, fields
-from passlib.hash import pbkdf2_sha512
-from ua_parser import user_agent_parser
 
 from app.models.auth import LoginSchema
 from app.routing import Blueprint
 from app.templating import render_template
 from app.utils import Status
 from app.utils.auth import create_user, is_authorized, requires_auth, verify_user
-from app.utils.db import delete_session, get_db, insert_session
+from app.utils.db import delete_session, get_db, insert_session, update_user_password
 from app.utils.forms import parser
+from app.utils.passwords import PASSWORD_HASHER_KEY, PasswordHasher
+from app.utils.sessions import forget_session
+from app.utils.signed_sessions import SESSION_SIGNER_KEY, SessionSigner, session_id
+from app.utils.user_agents import parse_user_agent
 
 
 class InviteCodeSchema(Schema):
     code = fields.UUID()
 
 
-async def login_user(request: web.Request, user_id: int, email: str, session_duration: int) -> web.Response:
-    metadata = user_agent_parser.Parse(request.headers.getone("User-Agent"))
-    browser = metadata["user_agent"]["family"]
-    operating_system = metadata["os"]["family"]
+async def login_user(
+    request: web.Request, user_id: int, email: str, session_duration: int, *, admin: bool = False
+) -> web.Response:
+    user_agent = parse_user_agent(request.app, request.headers.get("User-Agent", ""))
 
-    uuid = await insert_session(get_db(request), user_id=user_id, browser=browser, os=operating_system)
+    session = await insert_session(get_db(request), user_id=user_id, browser=user_agent.browser, os=user_agent.os)
+
+    value = str(session["token"])
+    signer: SessionSigner | None = request.app.get(SESSION_SIGNER_KEY)
+    if signer is not None:
+        value = signer.sign(session=session["token"], user_id=user_id, admin=admin, expires=session["expires"])
 
     res = web.HTTPFound("/dashboard")
     res.set_cookie(
         name="_session",
-        value=str(uuid),
+        value=value,
         max_age=session_duration,
         httponly=True,
         secure=not request.app["dev"],
@@ -100,7 +107,7 @@ async def login(request: web.Request) -> web.Response:
             )
 
         row = await get_db(request).fetchrow(
-            "SELECT id, password, session_duration FROM users WHERE email = $1", args["email"]
+            "SELECT id, password, session_duration, admin FROM users WHERE email = $1", args["email"]
         )
         if row is None:
             return await render_template(
@@ -113,8 +120,16 @@ async def login(request: web.Request) -> web.Response:
                 },
             )
 
-        if pbkdf2_sha512.verify(args["password"], row["password"]) is True:
-            return await login_user(request, row["id"], args["email"], row["session_duration"])
+        hasher: PasswordHasher = request.app[PASSWORD_HASHER_KEY]
+        if await hasher.verify(args["password"], row["password"]) is True:
+            if hasher.needs_update(row["password"]):
+                # this is the only time the plaintext is around to bring an old hash up to the current rounds
+                try:
+                    new_hash = await hasher.hash(args["password"])
+                    await update_user_password(get_db(request), user_id=row["id"], hashed_password=new_hash)
+                except web.HTTPServiceUnavailable:
+                    pass  # the hasher is busy, it will be rehashed on a later login
+            return await login_user(request, row["id"], args["email"], row["session_duration"], admin=row["admin"])
 
         # email is right password is wrong
         return await render_template(
@@ -133,8 +148,10 @@ async def login(request: web.Request) -> web.Response:
 @bp.get("/logout", name="logout")
 @requires_auth()
 async def logout(request: web.Request) -> web.Response:
-    token = request.cookies.get("_session")
+    token = session_id(request.app, request.cookies.get("_session", ""))
     res = web.HTTPFound("/")
     res.del_cookie("_session")
-    await delete_session(get_db(request), token=UUID(token))
+    if token is not None:
+        await delete_session(get_db(request), token=token)
+        forget_session(request.app, token)
     return res
@@ -1,24 +1,15 @@
-import asyncio
+from typing import Any
 
 import psutil
 from aiohttp import web
-from aiohttp_apispec import match_info_schema
 
-from app.models.shortener import ShortenerAliasSchema
-from app.routing import Blueprint
-from app.templating import render_template
+from app.models.shortener import MAX_ALIAS_LENGTH
+from app.routing import Blueprint, fast_path
+from app.templating import render_cached, render_template
 from app.utils.auth import is_authorized, requires_auth, verify_user
-from app.utils.db import (
-    add_short_url_click,
-    get_db,
-    select_notes_count,
-    select_short_url_destination,
-    select_short_urls_count,
-    select_total_notes_count,
-    select_total_sessions_count,
-    select_total_short_urls_count,
-    select_total_users_count,
-)
+from app.utils.clicks import CLICK_BUFFER_KEY
+from app.utils.db import get_db, select_counters
+from app.utils.shortener import get_short_url_destination
 
 bp = Blueprint(name="base")
 
@@ -28,51 +19,52 @@ async def login(request: web.Request) -> web.Response:
     if await is_authorized(request):
         return web.HTTPFound("/dashboard")
 
-    return await render_template("index", request)
+    return await render_cached("index", request)
 
 
 @bp.get("/dashboard", name="dashboard")
 @requires_auth(scopes=["id", "admin"])
 async def index(request: web.Request) -> web.Response:
-    async with get_db(request).acquire() as conn:
-        url_count = await select_short_urls_count(conn, owner=request["user"]["id"])
-        notes_count = await select_notes_count(conn, owner=request["user"]["id"])
-    return await render_template(
-        "dashboard/index",
-        request,
-        {
-            "url_count": url_count,
-            "notes_count": notes_count,
-        },
-    )
+    user = request["user"]
+
+    async def context() -> dict[str, Any]:
+        counters = await select_counters(get_db(request), owner=user["id"])
+        return {
+            "url_count": counters.get("urls", 0),
+            "notes_count": counters.get("notes", 0),
+        }
+
+    # the admin link in the layout is the only part that depends on the user, the data version covers the counts
+    return await render_cached("dashboard/index", request, context, key=user["admin"], owner=user["id"])
 
 
 @bp.get("/admin", name="admin")
 async def home(request: web.Request) -> web.Response:
-    async with get_db(request).acquire() as conn:
-        urls_count = await select_total_short_urls_count(conn)
-        users_count = await select_total_users_count(conn)
-        sessions_count = await select_total_sessions_count(conn)
-        notes_count = await select_total_notes_count(conn)
+    counters = await select_counters(get_db(request))
     return await render_template(
         "admin/index",
         request,
         {
-            "counters": {"urls": urls_count, "users": users_count, "sessions": sessions_count, "notes": notes_count},
+            "counters": {name: counters.get(name, 0) for name in ("urls", "users", "sessions", "notes")},
             "stats": {"cpu_percent": psutil.cpu_percent(), "memory_percent": psutil.virtual_memory()[2]},
         },
     )
 
 
 @bp.get("/{alias}", name="shortener")
-@match_info_schema(ShortenerAliasSchema)
+@fast_path
 async def shortener(request: web.Request) -> web.Response:
-    alias = request["match_info"]["alias"]
-    destination = await select_short_url_destination(get_db(request), alias=alias)
+    alias = request.match_info["alias"]
+    destination = None
+    # no alias can be longer than what ShortenerCreateSchema allows, so don't bother looking those up
+    if len(alias) <= MAX_ALIAS_LENGTH:
+        destination = await get_short_url_destination(request.app, alias)
     if destination is None:
-        return web.Response(body="No shortened URL with that alias was found.")  # TODO: make a view for this
+        # the shared 404 page, rendered once and cached
+        raise web.HTTPNotFound()
 
-    # run in background so that user can go to destination faster
-    asyncio.get_event_loop().create_task(add_short_url_click(get_db(request), alias=alias))
+    # counted in memory and flushed in batches so that user can go to destination faster
+    request.app[CLICK_BUFFER_KEY].add_short_url(alias)
 
-    return web.HTTPFound(destination)
+    # a plain response is a lot cheaper to build than the HTTPFound exception
+    return web.Response(status=302, headers={"Location": destination})
@@ -1,23 +1,20 @@
-import asyncio
 import base64
 import binascii
-import os
 import uuid
-from math import ceil
+from datetime import datetime
 
 from aiohttp import web
 from aiohttp_apispec import match_info_schema, querystring_schema
-from cryptography.fernet import Fernet, InvalidToken
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from marshmallow import Schema, ValidationError, fields, validate
 
 from app.routing import Blueprint
-from app.templating import render_template
+from app.templating import render_template, stream_template
 from app.utils.auth import requires_auth, verify_user
-from app.utils.db import get_db, select_notes, select_notes_count, select_user
+from app.utils.clicks import CLICK_BUFFER_KEY
+from app.utils.db import get_db, select_notes, select_user
 from app.utils.forms import parser
+from app.utils.notes import NOTE_KEYS_KEY, NoteKeys, decrypt_note, encrypt_note
+from app.utils.pagination import build_page, read_cursor
 
 
 class NoteSchema(Schema):
@@ -28,12 +25,23 @@ class NoteSchema(Schema):
     private = fields.Boolean(load_default=False)
 
 
+# sortable columns and their types, used to decode pagination cursors
+SORT_COLUMNS = {
+    "id": uuid.UUID,
+    "name": str,
+    "has_password": bool,
+    "share_email": bool,
+    "private": bool,
+    "clicks": int,
+    "creation_date": datetime,
+}
+
+
 class NotesFilterSchema(Schema):
-    page = fields.Integer(validate=validate.Range(min=1, error="Page must be greater than or equal to 1"))
+    after = fields.String()
+    before = fields.String()
     direction = fields.String(validate=validate.OneOf({"desc", "asc"}))
-    sortby = fields.String(
-        validate=validate.OneOf({"id", "name", "has_password", "share_email", "private", "clicks", "creation_date"})
-    )
+    sortby = fields.String(validate=validate.OneOf(SORT_COLUMNS))
 
 
 class ViewNoteSchema(Schema):
@@ -48,15 +56,6 @@ class PasswordIncorrectSchema(Schema):
     incorrect_password = fields.Boolean()
 
 
-def create_fernet(salt: bytes, password: bytes) -> Fernet:
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=100000, backend=default_backend())
-    return Fernet(base64.urlsafe_b64encode(kdf.derive(password)))
-
-
-def derive_salt_and_content(stored: bytes) -> tuple[bytes, bytes]:
-    return stored[:32], stored[32:]
-
-
 sub_bp = Blueprint("/notes", name="notes")
 
 
@@ -121,11 +120,8 @@ async def view_note_form(request: web.Request) -> web.Response:
         password = args.get("password")
         if password is None:
             return web.Response(text="Password required", status=401)
-        salt, encrypted_content = derive_salt_and_content(note["content"])
-        fernet = create_fernet(salt, password.encode())
-        try:
-            decoded = fernet.decrypt(encrypted_content).decode("utf-8")
-        except InvalidToken:
+        decoded = await decrypt_note(request.app, note_id=as_uuid, stored=note["content"], password=password)
+        if decoded is None:
             return web.HTTPFound(f"/notes/{note_id}?incorrect_password=True")
     else:
         decoded = note["content"].decode("utf-8")
@@ -134,9 +130,7 @@ async def view_note_form(request: web.Request) -> web.Response:
     if note["share_email"] is True:
         email = (await select_user(get_db(request), user_id=note["owner"])).get("email")
 
-    asyncio.get_event_loop().create_task(
-        get_db(request).execute("UPDATE notes SET clicks = clicks + 1 WHERE id = $1", as_uuid)
-    )
+    request.app[CLICK_BUFFER_KEY].add_note(as_uuid)
 
     return await render_template(
         "dashboard/notes/view_stylized", request, {"name": note["name"], "email": email, "content": decoded}
@@ -149,32 +143,30 @@ bp = Blueprint("/dashboard/notes", name="notes", subblueprints=[sub_bp])
 @bp.get("", name="index")
 @querystring_schema(NotesFilterSchema())
 @requires_auth(scopes=["id", "admin"])
-async def index(request: web.Request) -> web.Response:
-    current_page = request["querystring"].get("page", 1) - 1
+async def index(request: web.Request) -> web.StreamResponse:
     direction = request["querystring"].get("direction", "desc")
     sortby = request["querystring"].get("sortby", "creation_date")
+    cursor, backwards = read_cursor(
+        request["querystring"], sortby=sortby, direction=direction, columns=SORT_COLUMNS, tiebreaker="id"
+    )
 
-    async with get_db(request).acquire() as conn:
-        notes = await select_notes(
-            conn,
-            sortby=sortby,
-            direction=direction.upper(),
-            owner=request["user"]["id"],
-            offset=current_page * 50,
-        )
-        notes_count = await select_notes_count(conn, owner=request["user"]["id"])
-
-    max_pages = ceil(notes_count / 50)
+    notes = await select_notes(
+        get_db(request),
+        sortby=sortby,
+        direction=direction.upper(),
+        owner=request["user"]["id"],
+        cursor=cursor,
+        backwards=backwards,
+    )
+    page = build_page(notes, sortby=sortby, direction=direction, tiebreaker="id", cursor=cursor, backwards=backwards)
 
-    if max_pages == 0:
-        max_pages = 1
-    return await render_template(
+    return await stream_template(
         "dashboard/notes/index",
         request,
         {
-            "current_page": current_page + 1,
-            "max_pages": max_pages,
-            "values": notes,
+            "values": page.rows,
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
             "sortby": sortby,
             "direction": direction,
         },
@@ -202,10 +194,9 @@ async def create_note_form(request: web.Request) -> web.Response:
     password = args["password"]
 
     has_pw = False
+    key = None
     if password != "":
-        salt = os.urandom(32)
-        fernet = create_fernet(salt, password.encode())
-        stored = salt + fernet.encrypt(content.encode())
+        stored, key = await encrypt_note(request.app, content=content, password=password)
         has_pw = True
     else:
         stored = content.encode()
@@ -224,6 +215,11 @@ VALUES ($1, $2, $3, $4, $5, $6) returning id
     )
     id_ = await get_db(request).fetchval(query, *args)
 
+    if key is not None:
+        # whoever made the note is usually the first to open it
+        keys: NoteKeys = request.app[NOTE_KEYS_KEY]
+        keys.set(id_, password.encode(), key)
+
     id_ = base64.urlsafe_b64encode(str(id_).encode())
 
     return web.HTTPFound("/dashboard/notes")
@@ -16,6 +16,8 @@ from app.utils.db import (
     update_api_key,
 )
 from app.utils.forms import parser
+from app.utils.sessions import forget_session, forget_user
+from app.utils.signed_sessions import session_id
 from app.utils.time import get_amount_and_unit
 
 
@@ -44,6 +46,7 @@ async def regen_api_key(request: web.Request) -> web.Response:
     if request.method == "POST":
         async with get_db(request).acquire() as conn:
             await update_api_key(get_db(request), user_id=request["user"]["id"], api_key=await generate_api_key(conn))
+        forget_user(request.app, request["user"]["id"])
 
         return web.HTTPFound("/dashboard/settings/api_key")
 
@@ -54,10 +57,11 @@ async def regen_api_key(request: web.Request) -> web.Response:
 @requires_auth(scopes=["id", "admin"])
 async def sessions_settings(request: web.Request) -> web.Response:
     user_sessions = await select_sessions(get_db(request), user_id=request["user"]["id"])
+    current_session = session_id(request.app, request.cookies.get("_session", ""))
     return await render_template(
         "dashboard/settings/sessions",
         request,
-        {"sessions": user_sessions, "current_session": request.cookies.get("_session")},
+        {"sessions": user_sessions, "current_session": str(current_session)},
     )
 
 
@@ -67,6 +71,7 @@ async def sessions_settings(request: web.Request) -> web.Response:
 async def delete_session_(request: web.Request) -> web.Response:
     # no need for auth since uuids are unique
     await delete_session(get_db(request), token=request["match_info"]["token"])
+    forget_session(request.app, request["match_info"]["token"])
     return web.HTTPFound("/dashboard/settings/sessions")
 
 
@@ -116,6 +121,7 @@ async def edit_self(request: web.Request) -> web.Response:
 async def delete_account(request: web.Request) -> web.Response:
     if request.method == "POST":
         await delete_user(get_db(request), user_id=request["user"]["id"])
+        forget_user(request.app, request["user"]["id"])
 
         res = web.HTTPFound("/")
         res.del_cookie("_session")
@@ -1,6 +1,6 @@
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
 from json import dumps
-from math import ceil
 
 from aiohttp import web
 from aiohttp_apispec import match_info_schema, querystring_schema
@@ -8,25 +8,28 @@ from asyncpg import UniqueViolationError
 from marshmallow import ValidationError
 
 from app.models.shortener import (
+    SORT_COLUMNS,
     ShortenerAliasSchema,
     ShortenerCreateSchema,
     ShortenerEditSchema,
     ShortenerFilterSchema,
 )
 from app.routing import Blueprint
-from app.templating import render_template
+from app.templating import render_template, stream_template
 from app.utils.auth import requires_auth
 from app.utils.db import (
     delete_short_url,
     get_db,
     insert_short_url,
+    select_click_rollups_daily,
+    select_click_rollups_hourly,
     select_short_url,
     select_short_urls,
-    select_short_urls_count,
     update_short_url,
 )
 from app.utils.forms import parser
-from app.utils.shortener import generate_url_alias
+from app.utils.pagination import build_page, read_cursor
+from app.utils.shortener import create_short_url, remember_alias, update_short_url_to_random_alias
 
 bp = Blueprint("/dashboard/shortener", name="shortener")
 
@@ -34,32 +37,30 @@ bp = Blueprint("/dashboard/shortener", name="shortener")
 @bp.get("", name="index")
 @requires_auth(scopes=["id", "admin"])
 @querystring_schema(ShortenerFilterSchema())
-async def shortener(request: web.Request) -> web.Response:
-    current_page = request["querystring"].get("page", 1) - 1
+async def shortener(request: web.Request) -> web.StreamResponse:
     direction = request["querystring"].get("direction", "desc")
     sortby = request["querystring"].get("sortby", "creation_date")
+    cursor, backwards = read_cursor(
+        request["querystring"], sortby=sortby, direction=direction, columns=SORT_COLUMNS, tiebreaker="alias"
+    )
 
-    async with get_db(request).acquire() as conn:
-        urls = await select_short_urls(
-            conn,
-            sortby=sortby,
-            direction=direction.upper(),
-            owner=request["user"]["id"],
-            offset=current_page * 50,
-        )
-        urls_count = await select_short_urls_count(conn, owner=request["user"]["id"])
-
-    max_pages = ceil(urls_count / 50)
+    urls = await select_short_urls(
+        get_db(request),
+        sortby=sortby,
+        direction=direction.upper(),
+        owner=request["user"]["id"],
+        cursor=cursor,
+        backwards=backwards,
+    )
+    page = build_page(urls, sortby=sortby, direction=direction, tiebreaker="alias", cursor=cursor, backwards=backwards)
 
-    if max_pages == 0:
-        max_pages = 1
-    return await render_template(
+    return await stream_template(
         "dashboard/shortener/index",
         request,
         {
-            "current_page": current_page + 1,
-            "max_pages": max_pages,
-            "values": urls,
+            "values": page.rows,
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
             "sortby": sortby,
             "direction": direction,
         },
@@ -86,12 +87,14 @@ async def create_short_url_(request: web.Request) -> web.Response:
             )
 
         alias = args.get("alias")
-        if alias is None or alias == "":
-            alias = await generate_url_alias(get_db(request))
         destination = args.get("destination")
+        if alias is None or alias == "":
+            await create_short_url(request.app, owner=request["user"]["id"], destination=destination)
+            return web.HTTPFound("/dashboard/shortener")
 
         try:
             await insert_short_url(get_db(request), owner=request["user"]["id"], alias=alias, destination=destination)
+            remember_alias(request.app, alias)
         except UniqueViolationError:
             return await render_template(
                 "dashboard/shortener/create",
@@ -156,9 +159,14 @@ async def edit_short_url_(request: web.Request) -> web.Response:
             )
 
         new_alias = args.get("alias")
-        if new_alias is None or new_alias == "":
-            new_alias = await generate_url_alias(get_db(request))
         destination = args["destination"]
+        reset_clicks = args.get("reset_clicks", False)
+
+        if new_alias is None or new_alias == "":
+            await update_short_url_to_random_alias(
+                request.app, alias=alias, destination=destination, reset_clicks=reset_clicks
+            )
+            return web.HTTPFound("/dashboard/shortener")
 
         try:
             await update_short_url(
@@ -166,8 +174,9 @@ async def edit_short_url_(request: web.Request) -> web.Response:
                 alias=alias,
                 new_alias=new_alias,
                 destination=destination,
-                reset_clicks=args.get("reset_clicks", False),
+                reset_clicks=reset_clicks,
             )
+            remember_alias(request.app, new_alias)
         except UniqueViolationError:
             return await render_template(
                 "dashboard/shortener/edit",
@@ -231,6 +240,48 @@ async def delete_short_url_(request: web.Request) -> web.Response:
     )
 
 
+@bp.get("/{alias}/stats", name="stats")
+@requires_auth(scopes=["id", "admin"])
+@match_info_schema(ShortenerAliasSchema())
+async def short_url_stats(request: web.Request) -> web.Response:
+    alias = request["match_info"]["alias"]
+
+    short_url = await select_short_url(get_db(request), alias=alias)
+    if short_url is None:
+        return await render_template(
+            "dashboard/shortener/stats",
+            request,
+            {"error": {"title": "Unknown Short URL", "message": "Could not locate short URL"}},
+            status=404,
+        )
+
+    if short_url["owner"] != request["user"]["id"]:
+        return await render_template(
+            "dashboard/shortener/stats",
+            request,
+            {"error": {"title": "Missing Permissions", "message": "You aren't the owner of this short URL"}},
+            status=409,
+        )
+
+    # only the rollup tables are read here, the raw click events are never scanned for a page view
+    now = datetime.now(timezone.utc)
+    async with get_db(request).acquire() as conn:
+        hourly = await select_click_rollups_hourly(conn, alias=alias, since=now - timedelta(hours=48))
+        daily = await select_click_rollups_daily(conn, alias=alias, since=now - timedelta(days=30))
+
+    return await render_template(
+        "dashboard/shortener/stats",
+        request,
+        {
+            "alias": short_url["alias"],
+            "destination": short_url["destination"],
+            "clicks": short_url["clicks"],
+            "hourly": hourly,
+            "daily": daily,
+        },
+    )
+
+
 @bp.get("/sharex", name="sharex")
 @requires_auth(redirect=False, scopes=["api_key"])
 async def shortener_sharex_config(request: web.Request) -> web.Response:
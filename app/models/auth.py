@@ -1,4 +1,6 @@
 # pylint: disable=missing-class-docstring
+from datetime import datetime
+
 from marshmallow import Schema, fields, validate
 
 from app.utils.time import TIME_UNITS
@@ -29,6 +31,12 @@ class UserIDSchema(Schema):
     user_id = fields.Integer(require=True)
 
 
+# sortable columns and their types, used to decode pagination cursors
+USERS_SORT_COLUMNS = {"id": int, "email": str, "joined": datetime}
+
+
 class UsersFilterSchema(Schema):
+    after = fields.String()
+    before = fields.String()
     direction = fields.String(validate=validate.OneOf({"desc", "asc"}))
-    sortby = fields.String(validate=validate.OneOf({"id", "email", "joined"}))
+    sortby = fields.String(validate=validate.OneOf(USERS_SORT_COLUMNS))
@@ -1,7 +1,18 @@
+from datetime import datetime
 from typing import Callable
 
 from marshmallow import Schema, ValidationError, fields, validate
 
+MAX_ALIAS_LENGTH = 64
+MAX_BULK_DESTINATIONS = 1_000
+MAX_BULK_DESTINATION_LENGTH = 2_048
+# request bodies are limited app wide (see client_max_size in app_factory), this leaves room for the most and longest
+# destinations a bulk create takes, quoted and separated, plus whatever whitespace the client sends
+MAX_BODY_SIZE = 4 * 1024**2
+
+# sortable columns and their types, used to decode pagination cursors
+SORT_COLUMNS = {"alias": str, "destination": str, "clicks": int, "creation_date": datetime}
+
 
 def none_or_len(minimum: int, maximum: int) -> Callable[[str], None]:
     def validator(string: str) -> None:
@@ -19,17 +30,26 @@ class ShortenerAliasSchema(Schema):
 
 
 class ShortenerFilterSchema(Schema):
-    page = fields.Integer(validate=validate.Range(min=1, error="Page must be greater than or equal to 1"))
+    after = fields.String()
+    before = fields.String()
     direction = fields.String(validate=validate.OneOf({"desc", "asc"}))
-    sortby = fields.String(validate=validate.OneOf({"alias", "destination", "clicks", "creation_date"}))
+    sortby = fields.String(validate=validate.OneOf(SORT_COLUMNS))
 
 
 class ShortenerEditSchema(Schema):
-    alias = fields.String(validate=none_or_len(3, 64))
+    alias = fields.String(validate=none_or_len(3, MAX_ALIAS_LENGTH))
     destination = fields.URL(required=True, schemes={"http", "https"})
     reset_clicks = fields.Boolean()
 
 
 class ShortenerCreateSchema(Schema):
-    alias = fields.String(validate=none_or_len(3, 64))
+    alias = fields.String(validate=none_or_len(3, MAX_ALIAS_LENGTH))
     destination = fields.URL(required=True, schemes={"http", "https"})
+
+
+class ShortenerBulkCreateSchema(Schema):
+    destinations = fields.List(
+        fields.URL(schemes={"http", "https"}, validate=validate.Length(max=MAX_BULK_DESTINATION_LENGTH)),
+        required=True,
+        validate=validate.Length(min=1, max=MAX_BULK_DESTINATIONS),
+    )
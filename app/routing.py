@@ -1,10 +1,27 @@
 """Module for custom routing"""
 from __future__ import annotations
 
-from typing import Any, Iterable, List
+import re
+from functools import partial, update_wrapper
+from typing import Any, Callable, Iterable, Iterator, List
+from urllib.parse import quote, quote_plus
 
 from aiohttp import hdrs, web
 from aiohttp.web_routedef import AbstractRouteDef, RouteDef, _Deco, _HandlerType
+from aiohttp.web_urldispatcher import (
+    AbstractResource,
+    DynamicResource,
+    MatchInfoError,
+    PlainResource,
+    SystemRoute,
+    UrlMappingMatchInfo,
+)
+from aiohttp_apispec import validation_middleware
+
+from app import templating
+from app.utils.auth import verify_user
+from app.utils.compression import compression_middleware
+from app.utils.responses import json_response
 
 
 class Blueprint:
@@ -57,7 +74,7 @@ class Blueprint:
 
             for method in methods:
                 self.__route_table._items.append(  # pylint: disable=protected-access
-                    RouteDef(method, self.__prefix + path, handler, kwargs)
+                    RouteDef(method, self.__prefix + path, compile_handler(handler, method), kwargs)
                 )  # pylint: disable=protected-access
             return handler
 
@@ -88,6 +105,235 @@ class Blueprint:
         return self.route(path, methods=[hdrs.METH_DELETE], **kwargs)
 
 
+def fast_path(handler: _HandlerType) -> _HandlerType:
+    """Dispatch straight to the handler, with nothing but the error pages around it
+
+    Only meant for public routes that read and validate `request.match_info` themselves
+    """
+    setattr(handler, "fast_path", True)
+    return handler
+
+
+# describe the plain text body aiohttp gives the exception, which the JSON one replaces
+ERROR_BODY_HEADERS = frozenset({"content-type", "content-length"})
+
+
+async def handle_errors(request: web.Request, error: web.HTTPException) -> web.Response:
+    if error.status < 400:
+        # redirects and the like aren't errors, they go out as they are
+        raise error
+
+    if str(request.rel_url).startswith("/api"):
+        # ShareX and other API clients read the error from the message key. Allow on a 405, Retry-After on a 503 and
+        # the like still apply, only the body is replaced
+        headers = {name: value for name, value in error.headers.items() if name.lower() not in ERROR_BODY_HEADERS}
+        return json_response({"message": error.reason}, status=error.status, headers=headers)
+
+    if error.status in {403, 404, 500}:
+        # the error pages don't depend on the request
+        return await templating.render_cached(f"errors/{error.status}", request, status=error.status)
+
+    raise error
+
+
+def compile_handler(handler: _HandlerType, method: str) -> _HandlerType:
+    """Wrap a route handler in only the layers it needs
+
+    Done once when the route is added instead of every request checking which apply. From the outside in they are
+    compression, authentication, validation and the error pages, the order they ran in as app middlewares.
+    """
+    # class based views keep what requires_auth and the schemas set on their methods
+    function = getattr(handler, method.lower(), handler) if isinstance(handler, type) else handler
+
+    compiled = _error_pages(handler)
+    if getattr(function, "fast_path", False) is True:
+        return update_wrapper(compiled, function)
+
+    if hasattr(function, "__schemas__"):
+        compiled = partial(validation_middleware, handler=compiled)
+    if getattr(function, "requires_auth", False) is True:
+        compiled = _authentication(compiled, **function.auth)
+    compiled = partial(compression_middleware, handler=compiled)
+
+    # the attributes that requires_auth and the apispec decorators set stay readable on the route's handler
+    return update_wrapper(compiled, function)
+
+
+def _error_pages(handler: _HandlerType) -> _HandlerType:
+    async def error_pages(request: web.Request) -> web.StreamResponse:
+        try:
+            return await handler(request)
+        except web.HTTPException as error:
+            return await handle_errors(request, error)
+
+    return error_pages
+
+
+def _authentication(handler: _HandlerType, *, admin: bool, redirect: bool, scopes: Any) -> _HandlerType:
+    async def authentication(request: web.Request) -> web.StreamResponse:
+        try:
+            await verify_user(request, admin=admin, redirect=redirect, scopes=scopes)
+        except web.HTTPException as error:
+            return await handle_errors(request, error)
+        return await handler(request)
+
+    return authentication
+
+
+class _Node:
+    __slots__ = ("children", "param", "resources", "tails")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _Node] = {}
+        # a whole segment that's a variable with the default pattern
+        self.param: _Node | None = None
+        # resources whose path ends at this node
+        self.resources: List[AbstractResource] = []
+        # resources with a variable here that can't be split on / (a custom pattern or text around the variable),
+        # they match whatever is left of the path themselves
+        self.tails: List[AbstractResource] = []
+
+    def match(self, segments: List[str], index: int) -> Iterator[AbstractResource]:
+        if index == len(segments):
+            yield from self.resources
+        else:
+            # text is tried before variables, so /dashboard never has to compete with /{alias}
+            child = self.children.get(segments[index])
+            if child is not None:
+                yield from child.match(segments, index + 1)
+            if self.param is not None and segments[index]:
+                yield from self.param.match(segments, index + 1)
+        yield from self.tails
+
+
+# what yarl leaves unquoted, so the built urls match what resource.url_for and with_query give. yarl keeps some
+# colons in paths too, always quoting them is just as valid and doesn't depend on where they are
+PATH_SAFE = "!$&'()*+,/;=@"
+QUERY_SAFE = "!$'()*,/:?@"
+# ids, aliases and cursors are almost always made of these, which never need quoting
+UNRESERVED_RE = re.compile(r"[A-Za-z0-9_.~-]*")
+
+UrlBuilder = Callable[[dict[str, Any]], str]
+
+
+def _quote(value: Any, safe: str, quote_via: Callable[..., str] = quote) -> str:
+    value = str(value)
+    return value if UNRESERVED_RE.fullmatch(value) else quote_via(value, safe=safe)
+
+
+def _url_builder(resource: AbstractResource) -> UrlBuilder:
+    if isinstance(resource, PlainResource):
+        path = str(resource.url_for())
+        return lambda _: path
+
+    def build_with_yarl(parts: dict[str, Any]) -> str:
+        return str(resource.url_for(**{k: str(v) for k, v in parts.items()}))
+
+    if isinstance(resource, DynamicResource):
+        # e.g. "/dashboard/shortener/{alias}/edit", the fixed parts are already quoted
+        formatter = resource.get_info()["formatter"]
+
+        def build(parts: dict[str, Any]) -> str:
+            path = formatter.format_map({k: _quote(v, PATH_SAFE) for k, v in parts.items()})
+            # a leading // would make it a link to another host, yarl knows how to keep it a path
+            return build_with_yarl(parts) if path.startswith("//") else path
+
+        return build
+
+    return build_with_yarl
+
+
+class _ErrorPageRoute(SystemRoute):
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        return await compression_middleware(request, partial(handle_errors, error=self._http_exception))
+
+
+class ErrorPageMatchInfo(MatchInfoError):
+    """A path no route matched, shown with the error pages since there are no app middlewares to render them"""
+
+    __slots__ = ()
+
+    def __init__(self, http_exception: web.HTTPException) -> None:
+        super().__init__(http_exception)
+        self._route = _ErrorPageRoute(http_exception)
+
+
+class RadixRouter(web.UrlDispatcher):
+    """Finds the resource for a path by walking its segments instead of trying every resource in turn
+
+    Paths without variables are a dict lookup. The tree only narrows down the candidates, each one still does the
+    actual match, so patterns, methods and match_info work exactly as they do with the default router.
+
+    Passing a router to web.Application is deprecated and this relies on UrlDispatcher internals, which is why
+    requirements.txt keeps aiohttp to the minor release it was checked against.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._plain: dict[str, List[AbstractResource]] = {}
+        self._tree = _Node()
+        # sub apps and the like, tried after everything else
+        self._others: List[AbstractResource] = []
+        self._url_builders: dict[str, UrlBuilder] = {}
+
+    def freeze(self) -> None:
+        super().freeze()
+        # built once routes can't change anymore, rather than kept in sync through every way of adding one
+        for resource in self._resources:
+            if isinstance(resource, PlainResource):
+                self._plain.setdefault(resource.canonical, []).append(resource)
+            elif isinstance(resource, DynamicResource):
+                self._insert(resource)
+            else:
+                self._others.append(resource)
+
+        for name, resource in self.named_resources().items():
+            self._url_builders[name] = _url_builder(resource)
+
+    def url_builder(self, name: str) -> UrlBuilder | None:
+        """Builds the path for a named route from its match info, without yarl once the router is frozen"""
+        builder = self._url_builders.get(name)
+        if builder is None and name in self:
+            builder = _url_builder(self[name])
+        return builder
+
+    def _insert(self, resource: DynamicResource) -> None:
+        pattern = resource.get_info()["pattern"].pattern
+        node = self._tree
+        for segment in resource.canonical.split("/")[1:]:
+            if "{" not in segment:
+                node = node.children.setdefault(segment, _Node())
+            elif (
+                segment.startswith("{")
+                and segment.endswith("}")
+                and (f"(?P<{segment[1:-1]}>{DynamicResource.GOOD})" in pattern)
+            ):
+                if node.param is None:
+                    node.param = _Node()
+                node = node.param
+            else:
+                node.tails.append(resource)
+                return
+        node.resources.append(resource)
+
+    def _candidates(self, path: str) -> Iterator[AbstractResource]:
+        yield from self._plain.get(path, ())
+        yield from self._tree.match(path.split("/")[1:], 0)
+        yield from self._others
+
+    async def resolve(self, request: web.Request) -> UrlMappingMatchInfo:
+        allowed_methods: set[str] = set()
+        for resource in self._candidates(request.rel_url.path_safe):
+            match_info, allowed = await resource.resolve(request)
+            if match_info is not None:
+                return match_info
+            allowed_methods |= allowed
+
+        if allowed_methods:
+            return ErrorPageMatchInfo(web.HTTPMethodNotAllowed(request.method, allowed_methods))
+        return ErrorPageMatchInfo(web.HTTPNotFound())
+
+
 def register_blueprint(app: web.Application, blueprint: Blueprint) -> None:
     """Register routes"""
     app.router.add_routes(blueprint.route_table)
@@ -95,16 +341,15 @@ def register_blueprint(app: web.Application, blueprint: Blueprint) -> None:
 
 def url_for(app: web.Application, name: str, *, query: dict[str, str] = None, **match_info: str | int) -> str:
     """Finds the url for a named route"""
-    resource = app.router.get(name)
+    builder = app.router.url_builder(name)
 
-    if resource is None:
+    if builder is None:
         raise RuntimeError(f"No route with name {name} found")
 
-    parts = {k: str(v) for k, v in match_info.items()}
-
-    _url = resource.url_for(**parts)
+    url = builder(match_info)
     if query:
-        _url = _url.with_query(query)
-    url = str(_url)
+        url += "?" + "&".join(
+            [_quote(k, QUERY_SAFE, quote_plus) + "=" + _quote(v, QUERY_SAFE, quote_plus) for k, v in query.items()]
+        )
 
     return url
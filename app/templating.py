@@ -1,15 +1,28 @@
-from collections.abc import Awaitable, Callable
+import os
+import shutil
+from collections.abc import AsyncIterator, Awaitable, Callable
 from functools import cache
-from typing import Any, Optional
+from typing import Any, Hashable, Optional
 
 import jinja2
 from aiohttp import web
 
+from app.utils.cache import LRUCache, register_cache
+from app.utils.compression import COMPRESSOR_KEY
+from app.utils.notify import DATA_VERSION_CHANNEL, listen, on_reconnect
+
 ContextProcessor = Callable[[web.Request], Awaitable[dict[str, Any]]]
 
 TEMPLATE_SUFFIX = ".html.jinja"
 CONTEXT_PROCESSOR_KEY = "templating_context_processors"
 TEMPLATING_ENVIRONMENT_KEY = "templating_environment"
+FRAGMENT_CACHE_KEY = "templating_fragment_cache"
+
+TEMPLATES_DIR = "./templates"
+# written by scripts/templates.py, kept out of dist since that's served as static
+COMPILED_TEMPLATES_DIR = "./build/templates"
+# characters of rendered html stream_template sends per write
+STREAM_CHUNK_SIZE = 16 * 1024
 
 
 @cache
@@ -23,17 +36,38 @@ async def request_processor(request: web.Request) -> dict[str, web.Request]:
     return {"request": request}
 
 
+def create_environment(loader: jinja2.BaseLoader, **options: Any) -> jinja2.Environment:
+    # shared with scripts/templates.py, precompiled templates only load into an environment set up the same way
+    return jinja2.Environment(
+        loader=loader, enable_async=True, autoescape=options.pop("autoescape", jinja2.select_autoescape()), **options
+    )
+
+
+def compile_templates(target: str = COMPILED_TEMPLATES_DIR) -> None:
+    # from scratch, so a deleted template doesn't live on as a module
+    shutil.rmtree(target, ignore_errors=True)
+    create_environment(jinja2.FileSystemLoader(TEMPLATES_DIR)).compile_templates(target, zip=None, ignore_errors=False)
+
+
+def default_loader(*, precompiled: bool) -> jinja2.BaseLoader:
+    loader = jinja2.FileSystemLoader(TEMPLATES_DIR)
+    if precompiled and os.path.isdir(COMPILED_TEMPLATES_DIR):
+        # templates added since the last build still load from source
+        return jinja2.ChoiceLoader([jinja2.ModuleLoader(COMPILED_TEMPLATES_DIR), loader])
+    return loader
+
+
 def setup(
     app: web.Application,
     *,
-    loader: jinja2.FileSystemLoader | jinja2.PackageLoader = jinja2.FileSystemLoader("./templates"),
+    loader: jinja2.BaseLoader | None = None,
     global_functions: dict[str, Callable[[Any], Any]] = None,
     context_processors: list[ContextProcessor] = None,
     **options: Any,
 ) -> jinja2.Environment:
-    env = jinja2.Environment(
-        loader=loader, enable_async=True, autoescape=options.pop("autoescape", jinja2.select_autoescape()), **options
-    )
+    if loader is None:
+        loader = jinja2.FileSystemLoader(TEMPLATES_DIR)
+    env = create_environment(loader, **options)
     env.globals["app"] = app
     if global_functions:
         env.globals.update(global_functions)
@@ -68,6 +102,126 @@ async def render_template(
     )
 
 
+async def stream_template(
+    template_name: str,
+    request: web.Request,
+    context: dict[str, Any] = None,
+    status: int = 200,
+    *,
+    compress: bool = True,
+) -> web.StreamResponse:
+    """Like render_template, but sends the page as it renders instead of building it in memory first
+
+    The response is already sent by the time this returns, so only errors before the first chunk get an error page.
+    compression_middleware only sees it after that, so it's compressed here as it's written.
+    """
+    context = await get_context(request, context)
+    template = request.app[TEMPLATING_ENVIRONMENT_KEY].get_template(get_template_name(template_name))
+    chunks = buffered(template.generate_async(context))
+
+    # render up to the first chunk before committing to the status
+    first = await anext(chunks, b"")
+
+    response = web.StreamResponse(status=status)
+    response.content_type = "text/html"
+    response.charset = "utf-8"
+    stream = request.app[COMPRESSOR_KEY].stream(request, response) if compress else None
+    await response.prepare(request)
+
+    if stream is None:
+        await response.write(first)
+        async for chunk in chunks:
+            await response.write(chunk)
+    else:
+        await response.write(stream.compress(first))
+        async for chunk in chunks:
+            await response.write(stream.compress(chunk))
+        await response.write(stream.finish())
+    await response.write_eof()
+    return response
+
+
+async def buffered(events: AsyncIterator[str], size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    # jinja yields every bit of text between tags on its own, joining them saves a write per row
+    buffer: list[str] = []
+    length = 0
+    async for event in events:
+        buffer.append(event)
+        length += len(event)
+        if length >= size:
+            yield "".join(buffer).encode("utf-8")
+            buffer.clear()
+            length = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+class FragmentCache:
+    """Rendered pages, keyed on what they were rendered from and the version of their owner's data
+
+    Inserting or deleting an owner's urls or notes bumps their version (see notify_data_version() in schema.sql), so
+    pages rendered from the old data are never looked up again and age out of the cache. The TTL only bounds how long
+    a page can be stale when a notification never arrives
+    """
+
+    def __init__(self, cache: LRUCache[Hashable, bytes]) -> None:
+        self.cache = cache
+        self._versions: dict[int, int] = {}
+
+    def version(self, owner: int | None) -> int:
+        return 0 if owner is None else self._versions.get(owner, 0)
+
+    def bump(self, owner: int) -> None:
+        self._versions[owner] = self._versions.get(owner, 0) + 1
+
+    async def clear(self) -> None:
+        self.cache.clear()
+
+
+async def render_cached(
+    template_name: str,
+    request: web.Request,
+    context: dict[str, Any] | Callable[[], Awaitable[dict[str, Any]]] | None = None,
+    status: int = 200,
+    *,
+    key: Hashable = None,
+    owner: int | None = None,
+) -> web.Response:
+    """Like render_template, but reuses what was rendered last time
+
+    `key` has to cover anything else the page depends on, including what the context processors add. `context` can
+    be a function returning it, which is only called when the page has to be rendered
+    """
+    fragments: FragmentCache = request.app[FRAGMENT_CACHE_KEY]
+    # the version is read before the data is, a write in between leaves the page under a key that's already stale
+    cache_key = (template_name, status, key, owner, fragments.version(owner))
+
+    env = request.app[TEMPLATING_ENVIRONMENT_KEY]
+    # in dev templates are edited while the app runs, so nothing is reused
+    body = None if env.auto_reload else fragments.cache.get(cache_key)
+    if body is None:
+        if callable(context):
+            context = await context()
+        context = await get_context(request, context)
+        template = env.get_template(get_template_name(template_name))
+        body = (await template.render_async(context)).encode("utf-8")
+        if not env.auto_reload:
+            fragments.cache.set(cache_key, body)
+
+    return web.Response(body=body, status=status, content_type="text/html", charset="utf-8")
+
+
+async def setup_fragment_cache(app: web.Application) -> None:
+    config = app["config"].get("cache", {}).get("fragments", {})
+    cache: LRUCache[Hashable, bytes] = LRUCache(maxsize=config.get("size", 1000), ttl=config.get("ttl", 300))
+    fragments = FragmentCache(register_cache(app, "fragments", cache))
+    app[FRAGMENT_CACHE_KEY] = fragments
+
+    await listen(app, DATA_VERSION_CHANNEL, lambda payload: fragments.bump(int(payload)))
+    # any version bump sent while the listener was down is lost
+    on_reconnect(app, fragments.clear)
+
+
 async def render_string(source: str, request: web.Request, context: dict[str, Any], status: int = 200) -> web.Response:
     context = await get_context(request, context)
     template = request.app[TEMPLATING_ENVIRONMENT_KEY].from_string(source)
@@ -0,0 +1,90 @@
+"""Background maintenance for the click event log and its rollup tables"""
+
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+
+import sentry_sdk
+from aiohttp import web
+
+from app.utils.db import (
+    create_click_events_partition,
+    drop_click_events_partition,
+    get_db,
+    rollup_click_events,
+    select_click_events_partitions,
+    select_click_rollup_watermark,
+)
+
+ANALYTICS_TASK_KEY = "analytics_task"
+
+# every worker runs the job, the advisory lock makes sure only one of them does the work at a time
+ROLLUP_LOCK_ID = 7_461_001
+# workers starting together would otherwise race to create the same partition and fail on the duplicate
+PARTITION_LOCK_ID = 7_461_002
+
+PARTITIONS_AHEAD = 2
+
+
+async def maintain_partitions(app: web.Application, *, retention_days: int) -> None:
+    today = datetime.now(timezone.utc).date()
+    async with get_db(app).acquire() as conn, conn.transaction():
+        # waits instead of skipping, a worker that is starting up needs today's partition to exist when this returns
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", PARTITION_LOCK_ID)
+
+        for offset in range(PARTITIONS_AHEAD + 1):
+            await create_click_events_partition(conn, day=today + timedelta(days=offset))
+
+        oldest = today - timedelta(days=retention_days)
+        for name in await select_click_events_partitions(conn):
+            try:
+                day = datetime.strptime(name.removeprefix("click_events_"), "%Y%m%d").date()
+            except ValueError:
+                # not one of ours, e.g. a default partition someone added by hand
+                continue
+            if day < oldest:
+                await drop_click_events_partition(conn, day=day)
+
+
+async def rollup(app: web.Application) -> None:
+    async with get_db(app).acquire() as conn:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", ROLLUP_LOCK_ID):
+                return
+
+            watermark = await select_click_rollup_watermark(conn)
+            if watermark is None:
+                watermark = datetime.now(timezone.utc)
+            # clicks are buffered before they are written, so the hour before the watermark is redone
+            # to pick up events that landed late
+            await rollup_click_events(conn, since=watermark - timedelta(hours=1))
+
+
+async def run(app: web.Application, *, interval: float, retention_days: int) -> None:
+    last_maintenance: date | None = None
+    while True:
+        try:
+            today = datetime.now(timezone.utc).date()
+            if last_maintenance != today:
+                await maintain_partitions(app, retention_days=retention_days)
+                last_maintenance = today
+            await rollup(app)
+        except Exception:  # pylint: disable=broad-except
+            sentry_sdk.capture_exception()
+        await asyncio.sleep(interval)
+
+
+async def setup_click_analytics(app: web.Application) -> None:
+    config = app["config"].get("analytics", {})
+    retention_days = config.get("retention_days", 30)
+
+    # make sure today's partition exists before the first clicks get flushed
+    await maintain_partitions(app, retention_days=retention_days)
+
+    app[ANALYTICS_TASK_KEY] = asyncio.create_task(
+        run(app, interval=config.get("rollup_interval", 300), retention_days=retention_days)
+    )
+
+    async def close(_app: web.Application) -> None:
+        _app[ANALYTICS_TASK_KEY].cancel()
+
+    app.on_cleanup.append(close)
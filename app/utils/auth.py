@@ -1,3 +1,4 @@
+from contextlib import suppress
 from secrets import choice
 from string import ascii_letters, digits
 from types import MappingProxyType
@@ -7,22 +8,25 @@ from uuid import UUID
 from aiohttp import web
 from asyncpg import Record, UniqueViolationError
 from marshmallow import ValidationError
-from passlib.hash import pbkdf2_sha512
 
 from app.models.auth import SignUpSchema, UsersEditSchema
 from app.templating import render_template
 from app.utils import QueryScopes, Scopes, Status
 from app.utils.db import (
     ConnOrPool,
+    api_key_digest,
+    claim_invite,
     get_db,
+    get_hash_and_id_by_email,
     insert_user,
+    select_invite,
     select_api_key_exists,
-    select_session_exists,
-    select_user_by_api_key,
-    select_user_by_session,
     update_user,
 )
 from app.utils.forms import parser
+from app.utils.passwords import PASSWORD_HASHER_KEY
+from app.utils.sessions import forget_user, get_user, user_exists
+from app.utils.signed_sessions import SESSION_SIGNER_KEY, TOKEN_SCOPES
 from app.utils.time import get_seconds
 
 API_KEY_VALID_CHARS = ascii_letters + digits + "!@%^&?<>:;+=-_~"
@@ -31,7 +35,7 @@ API_KEY_VALID_CHARS = ascii_letters + digits + "!@%^&?<>:;+=-_~"
 async def generate_api_key(database: ConnOrPool) -> str:
     while True:
         api_key = "".join(choice(API_KEY_VALID_CHARS) for _ in range(256))
-        if await select_api_key_exists(database, api_key=api_key) is False:
+        if await select_api_key_exists(database, digest=api_key_digest(api_key)) is False:
             break
     return api_key
 
@@ -84,21 +88,34 @@ async def verify_user(request: web.Request, *, admin: bool = False, redirect: bo
     if admin is True and scopes is None:
         raise ValueError("Cannot determine if user is admin without any scopes")
 
-    async def by_session():
-        session = request.cookies.get("_session")
-        if session is not None:
-            if scopes is None:
-                return await select_session_exists(get_db(request), token=UUID(session))
-            return await select_user_by_session(get_db(request), token=UUID(session), scopes=["*"])
+    if isinstance(scopes, str):
+        scopes = [scopes]
 
-    async def by_api_key():
-        api_key = request.headers.get("x-api-key")
-        if api_key is not None:
-            if scopes is None:
-                return await select_api_key_exists(get_db(request), api_key=api_key)
-            return await select_user_by_api_key(get_db(request), api_key=api_key, scopes=["*"])
+    session = request.cookies.get("_session")
+    api_key = request.headers.get("x-api-key")
 
-    user = await by_session() or await by_api_key()
+    user = None
+    token = None
+    if session is not None:
+        signer = request.app.get(SESSION_SIGNER_KEY)
+        claims = signer.verify(session) if signer is not None else None
+        if claims is not None:
+            token = claims.session
+            if scopes is None:
+                user = True
+            elif TOKEN_SCOPES.issuperset(scopes):
+                # everything the route asked for is in the cookie, no need for the database
+                user = MappingProxyType({"id": claims.user_id, "admin": claims.admin})
+        else:
+            with suppress(ValueError):
+                token = UUID(session)
+
+    if user is None and (token is not None or api_key is not None):
+        # whichever credentials were sent are resolved together, a miss is one query either way
+        if scopes is None:
+            user = await user_exists(request.app, token=token, api_key=api_key) or None
+        else:
+            user = await get_user(request.app, token=token, api_key=api_key, scopes=scopes)
 
     if user is None:
         response = web.HTTPUnauthorized()
@@ -133,44 +150,66 @@ async def create_user(
 
         return Status.ERROR, await render_template(template, request, ctx, status=400)
 
-    try:
-        async with get_db(request).acquire() as conn:
-            invite = await conn.fetchrow(
-                "SELECT used_by, required_email FROM invites WHERE code = $1", args["invite_code"]
-            )
-            if invite["used_by"] is not None:
-                ctx = {"invite_code_error": ["This invite code has already been used"]}
-                ctx.update(extra_ctx)
-                return Status.ERROR, await render_template(template, request, ctx, status=409)
-
-            if invite["required_email"] is not None and invite["required_email"] != args["email"]:
-                ctx = {
-                    "invite_code_error": [
-                        "Your email does not match the email specified by the owner of the invite code"
-                    ],
-                    "email": args["email"],
-                    "password": args["password"],
-                }
-                ctx.update(extra_ctx)
-                return Status.ERROR, await render_template(template, request, ctx, status=409)
-
-            user_id = await insert_user(
-                conn,
-                email=args["email"],
-                api_key=await generate_api_key(conn),
-                hashed_password=pbkdf2_sha512.hash(args["password"]),
-            )
-
-            await conn.execute("UPDATE invites SET used_by = $1 WHERE code = $2", user_id, args["invite_code"])
-    except UniqueViolationError:
-        ctx = {
+    def invite_used() -> dict[str, Any]:
+        return {"invite_code_error": ["This invite code has already been used"], **extra_ctx}
+
+    def email_taken() -> dict[str, Any]:
+        return {
             "email_error": ["A user with this email already exists"],
             "email": args["email"],
             "password": args["password"],
+            **extra_ctx,
+        }
+
+    # everything that can turn the request down is checked before the password is hashed, a made up invite code
+    # shouldn't cost a trip through the process pool
+    invite = await select_invite(get_db(request), code=args["invite_code"])
+    if invite is None:
+        ctx = {"invite_code_error": ["This invite code does not exist"], **extra_ctx}
+        return Status.ERROR, await render_template(template, request, ctx, status=404)
+
+    if invite["used_by"] is not None:
+        return Status.ERROR, await render_template(template, request, invite_used(), status=409)
+
+    if invite["required_email"] is not None and invite["required_email"] != args["email"]:
+        ctx = {
+            "invite_code_error": ["Your email does not match the email specified by the owner of the invite code"],
+            "email": args["email"],
+            "password": args["password"],
+            **extra_ctx,
         }
-        ctx.update(extra_ctx)
         return Status.ERROR, await render_template(template, request, ctx, status=409)
 
+    if await get_hash_and_id_by_email(get_db(request), email=args["email"]) is not None:
+        return Status.ERROR, await render_template(template, request, email_taken(), status=409)
+
+    # hashed before a connection is taken from the pool, it doesn't need one
+    hashed_password = await request.app[PASSWORD_HASHER_KEY].hash(args["password"])
+
+    try:
+        async with get_db(request).acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                user_id = await insert_user(
+                    conn,
+                    email=args["email"],
+                    api_key=await generate_api_key(conn),
+                    hashed_password=hashed_password,
+                )
+                # the checks above ran before hashing, another signup may have used the invite since
+                claimed = await claim_invite(conn, code=args["invite_code"], user_id=user_id)
+            except BaseException:
+                await transaction.rollback()
+                raise
+
+            if not claimed:
+                await transaction.rollback()
+                return Status.ERROR, await render_template(template, request, invite_used(), status=409)
+            await transaction.commit()
+    except UniqueViolationError:
+        return Status.ERROR, await render_template(template, request, email_taken(), status=409)
+
     return Status.OK, user_id, args["email"]
 
 
@@ -210,6 +249,7 @@ async def edit_user(
             session_duration=get_seconds(args["session_duration_amount"], args["session_duration_unit"]),
             email=args["email"],
         )
+        forget_user(request.app, old_user["id"])
     except UniqueViolationError:
         ctx = {
             "email_error": ["A user with this email already exists"],
@@ -0,0 +1,53 @@
+from hashlib import blake2b
+from math import ceil, exp, log
+from typing import Any, Iterable
+
+
+class BloomFilter:
+    """Set membership with false positives but never false negatives"""
+
+    def __init__(self, capacity: int, false_positive_rate: float) -> None:
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.size = ceil(-capacity * log(false_positive_rate) / log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * log(2)))
+        self.count = 0
+        self._bits = bytearray(ceil(self.size / 8))
+
+    def _indexes(self, item: str) -> Iterable[int]:
+        # double hashing, two 64 bit halves of one digest stand in for `hash_count` independent hashes
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for index in self._indexes(item):
+            self._bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def update(self, items: Iterable[str]) -> None:
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(item))
+
+    @property
+    def memory(self) -> int:
+        return len(self._bits)
+
+    @property
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "items": f"{self.count:,}",
+            "capacity": f"{self.capacity:,}",
+            "hash_count": self.hash_count,
+            "memory": f"{self.memory / 1024:,.2f} KB",
+            "configured_false_positive_rate": f"{self.false_positive_rate:.4%}",
+            "estimated_false_positive_rate": f"{self.estimated_false_positive_rate:.4%}",
+        }
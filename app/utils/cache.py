@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Generic, Hashable, TypeVar
+
+from aiohttp import web
+
+CACHES_KEY = "caches"
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """Size bounded LRU cache where every entry also expires after `ttl` seconds"""
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires, value = item
+        if expires < monotonic():
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        """`ttl` shortens the cache wide ttl for this entry"""
+        if self.maxsize <= 0:
+            return
+
+        if ttl is None or (self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        expires = monotonic() + ttl if ttl is not None else float("inf")
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: K) -> None:
+        """Invalidate a single entry"""
+        if self._data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def pop_where(self, predicate: Callable[[V], bool]) -> None:
+        """Invalidate every entry whose value matches, for when the key isn't known"""
+        for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+            del self._data[key]
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.invalidations += len(self._data)
+        self._data.clear()
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": f"{len(self._data):,}",
+            "maxsize": f"{self.maxsize:,}",
+            "hits": f"{self.hits:,}",
+            "misses": f"{self.misses:,}",
+            "hit_ratio": f"{self.hits / lookups if lookups else 0:.1%}",
+            "evictions": f"{self.evictions:,}",
+            "invalidations": f"{self.invalidations:,}",
+        }
+
+
+def register_cache(app: web.Application, name: str, cache: LRUCache) -> LRUCache:
+    """Register a cache so its counters show up on the admin application page"""
+    app.setdefault(CACHES_KEY, {})[name] = cache
+    return cache
@@ -0,0 +1,131 @@
+"""Coalesces click increments in memory and writes them in batches"""
+
+import asyncio
+from collections import Counter
+from contextlib import suppress
+from datetime import datetime, timezone
+from uuid import UUID
+
+import sentry_sdk
+from aiohttp import web
+
+from app.utils.db import (
+    add_note_clicks,
+    add_short_url_clicks,
+    get_db,
+    insert_click_events,
+)
+
+CLICK_BUFFER_KEY = "click_buffer"
+
+
+class ClickBuffer:
+    def __init__(self, app: web.Application, *, flush_interval: float, flush_count: int, max_events: int) -> None:
+        self.app = app
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        self.max_events = max_events
+
+        self._short_urls: Counter[str] = Counter()
+        self._notes: Counter[UUID] = Counter()
+        # individual short url clicks for the analytics event log
+        self._events: list[tuple[str, datetime]] = []
+        self._dropped_events = 0
+        self._pending = 0
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._early_flush: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        await self.flush()
+
+    def add_short_url(self, alias: str) -> None:
+        self._short_urls[alias] += 1
+        # the counts matter more than the event log, so while events can't be written they're dropped past the cap
+        if len(self._events) < self.max_events:
+            self._events.append((alias, datetime.now(timezone.utc)))
+        else:
+            self._dropped_events += 1
+        self._added()
+
+    def add_note(self, note_id: UUID) -> None:
+        self._notes[note_id] += 1
+        self._added()
+
+    def _added(self) -> None:
+        self._pending += 1
+        # only one early flush is scheduled at a time, a burst of clicks would otherwise queue one per click
+        if self._pending >= self.flush_count and self._early_flush is None:
+            self._early_flush = asyncio.create_task(self.flush())
+            self._early_flush.add_done_callback(self._early_flush_done)
+
+    def _early_flush_done(self, _: asyncio.Task) -> None:
+        self._early_flush = None
+
+    async def flush(self) -> None:
+        async with self._lock:
+            short_urls, self._short_urls = self._short_urls, Counter()
+            notes, self._notes = self._notes, Counter()
+            events, self._events = self._events, []
+            dropped, self._dropped_events = self._dropped_events, 0
+            self._pending = 0
+
+            if dropped:
+                sentry_sdk.capture_message(f"Dropped {dropped} click events, the event buffer was full")
+
+            if short_urls or notes:
+                try:
+                    async with get_db(self.app).acquire() as conn, conn.transaction():
+                        if short_urls:
+                            # sorted so concurrent flushes from other workers lock rows in the same order
+                            aliases = sorted(short_urls)
+                            await add_short_url_clicks(conn, aliases=aliases, counts=[short_urls[a] for a in aliases])
+                        if notes:
+                            note_ids = sorted(notes)
+                            await add_note_clicks(conn, note_ids=note_ids, counts=[notes[n] for n in note_ids])
+                except Exception:  # pylint: disable=broad-except
+                    # keep the clicks around for the next flush instead of dropping them
+                    self._short_urls.update(short_urls)
+                    self._notes.update(notes)
+                    self._pending += sum(short_urls.values()) + sum(notes.values())
+                    sentry_sdk.capture_exception()
+
+            # separately, so a missing partition only costs the event log and not the counts
+            if events:
+                try:
+                    await insert_click_events(get_db(self.app), events=events)
+                except Exception:  # pylint: disable=broad-except
+                    # a failing COPY usually keeps failing, retrying would only grow the buffer
+                    sentry_sdk.capture_exception()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+def setup_click_buffer(app: web.Application) -> ClickBuffer:
+    config = app["config"].get("clicks", {})
+    buffer = ClickBuffer(
+        app,
+        flush_interval=config.get("flush_interval", 5),
+        flush_count=config.get("flush_count", 1000),
+        max_events=config.get("max_events", 100_000),
+    )
+    buffer.start()
+    app[CLICK_BUFFER_KEY] = buffer
+
+    async def close(_app: web.Application) -> None:
+        await buffer.close()
+
+    # has to run before the pool is closed so the last clicks still make it to the database
+    app.on_cleanup.append(close)
+
+    return buffer
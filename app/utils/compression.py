@@ -0,0 +1,269 @@
+"""Compresses HTML and JSON responses
+
+gzip is always available, brotli and zstd are used when their packages are installed. Bodies over the executor
+threshold are compressed in a thread so a big page doesn't hold up the event loop, the compressors release the GIL.
+Streamed pages are compressed as they're written, see `ResponseCompressor.stream`.
+"""
+
+import asyncio
+import gzip
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import partial
+from time import thread_time
+from typing import Any, Callable, NamedTuple
+
+from aiohttp import hdrs, web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class StreamEncoder(NamedTuple):
+    # each chunk comes back flushed, so a streamed page still reaches the browser as it renders
+    compress: Callable[[bytes], bytes]
+    finish: Callable[[], bytes]
+
+
+try:
+    # python 3.14+
+    from compression import zstd
+
+    def zstd_encoder(level: int) -> Callable[[bytes], bytes]:
+        return lambda data: zstd.compress(data, level=level)
+
+    def zstd_stream_encoder(level: int) -> StreamEncoder:
+        compressor = zstd.ZstdCompressor(level=level)
+        return StreamEncoder(
+            lambda data: compressor.compress(data, mode=zstd.ZstdCompressor.FLUSH_BLOCK), compressor.flush
+        )
+
+except ImportError:
+    try:
+        import zstandard
+
+        def zstd_encoder(level: int) -> Callable[[bytes], bytes]:
+            # a compressor object can't be shared between the executor's threads
+            return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+
+        def zstd_stream_encoder(level: int) -> StreamEncoder:
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            return StreamEncoder(
+                lambda data: compressor.compress(data) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush,
+            )
+
+    except ImportError:
+        zstd_encoder = None  # type: ignore[assignment]
+        zstd_stream_encoder = None  # type: ignore[assignment]
+
+COMPRESSOR_KEY = "response_compressor"
+
+DEFAULT_CONTENT_TYPES = ("text/html", "application/json", "text/plain", "text/css", "application/javascript")
+DEFAULT_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+
+
+def _encoders(levels: dict[str, int]) -> dict[str, Callable[[bytes], bytes]]:
+    # in order of preference when a client accepts several, zstd and brotli both beat gzip on ratio and speed
+    encoders: dict[str, Callable[[bytes], bytes]] = {}
+    if zstd_encoder is not None:
+        encoders["zstd"] = zstd_encoder(levels.get("zstd", DEFAULT_LEVELS["zstd"]))
+    if brotli is not None:
+        quality = levels.get("br", DEFAULT_LEVELS["br"])
+        encoders["br"] = lambda data: brotli.compress(data, quality=quality)
+    level = levels.get("gzip", DEFAULT_LEVELS["gzip"])
+    # mtime=0 so the same body always compresses to the same bytes
+    encoders["gzip"] = lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    return encoders
+
+
+def _stream_encoders(levels: dict[str, int]) -> dict[str, Callable[[], StreamEncoder]]:
+    # same order as _encoders, a fresh encoder per response
+    encoders: dict[str, Callable[[], StreamEncoder]] = {}
+    if zstd_stream_encoder is not None:
+        encoders["zstd"] = partial(zstd_stream_encoder, levels.get("zstd", DEFAULT_LEVELS["zstd"]))
+    if brotli is not None:
+        encoders["br"] = partial(_brotli_stream_encoder, levels.get("br", DEFAULT_LEVELS["br"]))
+    encoders["gzip"] = partial(_gzip_stream_encoder, levels.get("gzip", DEFAULT_LEVELS["gzip"]))
+    return encoders
+
+
+def _brotli_stream_encoder(quality: int) -> StreamEncoder:
+    compressor = brotli.Compressor(quality=quality)
+    return StreamEncoder(lambda data: compressor.process(data) + compressor.flush(), compressor.finish)
+
+
+def _gzip_stream_encoder(level: int) -> StreamEncoder:
+    # wbits=31 writes the gzip header and trailer, with the mtime left at 0 like gzip.compress above
+    compressor = zlib.compressobj(level, wbits=31)
+    return StreamEncoder(lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush)
+
+
+def accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in header.lower().split(","):
+        coding, _, params = part.partition(";")
+        _, _, quality = params.partition("q=")
+        try:
+            # q=0 means the client refuses it
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip())
+    return accepted
+
+
+@dataclass
+class RouteStats:
+    responses: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    cpu_time: float = 0.0
+
+
+class ResponseCompressor:
+    def __init__(
+        self, *, min_size: int, executor_threshold: int, content_types: tuple[str, ...], levels: dict[str, int]
+    ) -> None:
+        self.min_size = min_size
+        self.executor_threshold = executor_threshold
+        self.content_types = frozenset(content_types)
+        self.encoders = _encoders(levels)
+        self.stream_encoders = _stream_encoders(levels)
+        self.routes: defaultdict[str, RouteStats] = defaultdict(RouteStats)
+
+    def _accepted(self, request: web.Request, response: web.StreamResponse) -> str | None:
+        if hdrs.CONTENT_ENCODING in response.headers or response.content_type not in self.content_types:
+            return None
+
+        accepted = accepted_encodings(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+        return next((encoding for encoding in self.encoders if encoding in accepted), None)
+
+    def choose(self, request: web.Request, response: web.StreamResponse) -> str | None:
+        # only complete bodies are compressed here, streamed responses use stream() and file responses send the
+        # precompressed copies
+        if type(response) is not web.Response or response.prepared:  # pylint: disable=unidiomatic-typecheck
+            return None
+        body = response.body
+        if not isinstance(body, bytes) or len(body) < self.min_size:
+            return None
+        return self._accepted(request, response)
+
+    def stream(self, request: web.Request, response: web.StreamResponse) -> "CompressedStream | None":
+        """Sets up compressing a streamed response, before it's prepared since that sends the headers
+
+        There's no size to check up front, streamed pages are the long ones anyway
+        """
+        if response.prepared:
+            return None
+        encoding = self._accepted(request, response)
+        if encoding is None:
+            return None
+
+        response.headers[hdrs.CONTENT_ENCODING] = encoding
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+        return CompressedStream(self, route_label(request), self.stream_encoders[encoding]())
+
+    def _compress(self, encoding: str, body: bytes) -> tuple[bytes, float]:
+        # thread_time and not perf_counter, waiting for the executor isn't compression time
+        start = thread_time()
+        compressed = self.encoders[encoding](body)
+        return compressed, thread_time() - start
+
+    async def compress(self, request: web.Request, response: web.Response, encoding: str) -> None:
+        body: bytes = response.body  # type: ignore[assignment]
+        if len(body) >= self.executor_threshold:
+            compressed, cpu_time = await asyncio.get_running_loop().run_in_executor(
+                None, self._compress, encoding, body
+            )
+        else:
+            compressed, cpu_time = self._compress(encoding, body)
+
+        response.body = compressed
+        response.headers[hdrs.CONTENT_ENCODING] = encoding
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+
+        self.record(route_label(request), bytes_in=len(body), bytes_out=len(compressed), cpu_time=cpu_time)
+
+    def record(self, route: str, *, bytes_in: int, bytes_out: int, cpu_time: float) -> None:
+        stats = self.routes[route]
+        stats.responses += 1
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.cpu_time += cpu_time
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "encodings": ", ".join(self.encoders),
+            "routes": {
+                route: {
+                    "responses": f"{stats.responses:,}",
+                    "bytes_in": f"{stats.bytes_in / 1024:,.2f} KB",
+                    "bytes_out": f"{stats.bytes_out / 1024:,.2f} KB",
+                    "ratio": f"{stats.bytes_in / stats.bytes_out if stats.bytes_out else 0:,.2f}x",
+                    "cpu_time": f"{stats.cpu_time * 1000:,.2f} ms",
+                    "average_cpu_time": f"{stats.cpu_time / stats.responses * 1000:,.3f} ms",
+                }
+                for route, stats in sorted(self.routes.items(), key=lambda item: item[1].cpu_time, reverse=True)
+            },
+        }
+
+
+class CompressedStream:
+    """Compresses a streamed response a chunk at a time, counted in the stats once it's finished"""
+
+    def __init__(self, compressor: ResponseCompressor, route: str, encoder: StreamEncoder) -> None:
+        self.compressor = compressor
+        self.route = route
+        self.encoder = encoder
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def compress(self, chunk: bytes) -> bytes:
+        start = thread_time()
+        compressed = self.encoder.compress(chunk)
+        self.cpu_time += thread_time() - start
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def finish(self) -> bytes:
+        start = thread_time()
+        compressed = self.encoder.finish()
+        self.cpu_time += thread_time() - start
+        self.bytes_out += len(compressed)
+        self.compressor.record(self.route, bytes_in=self.bytes_in, bytes_out=self.bytes_out, cpu_time=self.cpu_time)
+        return compressed
+
+
+def route_label(request: web.Request) -> str:
+    # the route's pattern rather than the path, so the stats don't grow with every alias or id
+    route = request.match_info.route
+    if route.resource is None:
+        return "(no route)"
+    return f"{request.method} {route.resource.canonical}"
+
+
+@web.middleware
+async def compression_middleware(request: web.Request, handler):
+    response = await handler(request)
+    compressor: ResponseCompressor = request.app[COMPRESSOR_KEY]
+    encoding = compressor.choose(request, response)
+    if encoding is not None:
+        await compressor.compress(request, response, encoding)
+    return response
+
+
+def setup_compression(app: web.Application) -> None:
+    config = app["config"].get("compression", {})
+    app[COMPRESSOR_KEY] = ResponseCompressor(
+        min_size=config.get("min_size", 1024),
+        executor_threshold=config.get("executor_threshold", 32 * 1024),
+        content_types=tuple(config.get("content_types", DEFAULT_CONTENT_TYPES)),
+        levels=config.get("levels", {}),
+    )
@@ -1,10 +1,19 @@
-from typing import List, Union, cast
+from datetime import date, datetime, timedelta
+from hashlib import sha256
+from typing import AsyncIterator, Iterable, List, Union, cast
 from uuid import UUID
 
 from aiohttp import web
 from asyncpg import Connection, Pool, Record
 
 from app.utils import QueryScopes
+from app.utils.notify import (
+    DATA_VERSION_CHANNEL,
+    SESSION_CHANNEL,
+    SHORT_URL_CHANNEL,
+    SHORT_URL_CREATED_CHANNEL,
+)
+from app.utils.pagination import PAGE_SIZE, Cursor
 
 ConnOrPool = Union[Connection, Pool]
 
@@ -13,60 +22,143 @@ def form_scopes(scopes: QueryScopes) -> str:
     return scopes if isinstance(scopes, str) else ", ".join(scopes)
 
 
+def keyset(sortby: str, tiebreaker: str, direction: str, *, backwards: bool, param: int) -> tuple[str, str]:
+    """Build the WHERE condition and ORDER BY for one page of keyset pagination
+
+    `param` is the placeholder number the sort value goes in, the tiebreaker goes in the one after it
+    """
+    descending = (direction.lower() == "desc") != backwards
+    comparison = "<" if descending else ">"
+    order = "DESC" if descending else "ASC"
+    return f"({sortby}, {tiebreaker}) {comparison} (${param}, ${param + 1})", f"{sortby} {order}, {tiebreaker} {order}"
+
+
+def api_key_digest(api_key: str) -> bytes:
+    """API keys are looked up by this instead of the plaintext so the lookup can use a fixed width index"""
+    # the keys are 256 random characters, a plain sha256 is enough
+    return sha256(api_key.encode()).digest()
+
+
 def get_db(request_or_app: web.Request | web.Application) -> Pool:
+    app = request_or_app
     if isinstance(request_or_app, web.Request):
         app = request_or_app.app
     return cast(Pool, app["db"])
 
 
-async def select_notes(conn: ConnOrPool, *, sortby: str, direction: str, owner: int, offset: int) -> List[Record]:
+async def notify(conn: ConnOrPool, *, channel: str, payload: str):
+    return await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+
+async def notify_user_changed(conn: ConnOrPool, *, user_id: int):
+    """Drop the user's sessions from every worker's session cache"""
+    return await notify(conn, channel=SESSION_CHANNEL, payload=f"user:{user_id}")
+
+
+async def select_counter(conn: ConnOrPool, *, name: str, owner: int = 0) -> int:
+    """Row count kept by the counters triggers, `owner` 0 is the total for the whole table"""
+    return await conn.fetchval("SELECT value FROM counters WHERE name = $1 AND owner = $2", name, owner) or 0
+
+
+async def select_counters(conn: ConnOrPool, *, owner: int = 0) -> dict[str, int]:
+    """Every counter for `owner` in one query"""
+    return dict(await conn.fetch("SELECT name, value FROM counters WHERE owner = $1", owner))
+
+
+async def rebuild_counters(conn: ConnOrPool) -> List[Record]:
+    """Recount every counter, returns the ones that had drifted with their stored and actual values"""
+    drifted = await conn.fetch("SELECT * FROM rebuild_counters()")
+    # pages showing the old counts are cached until the owner's data version changes
+    for owner in {row["owner"] for row in drifted if row["owner"] != 0}:
+        await notify(conn, channel=DATA_VERSION_CHANNEL, payload=str(owner))
+    return drifted
+
+
+async def select_notes(
+    conn: ConnOrPool, *, sortby: str, direction: str, owner: int, cursor: Cursor | None, backwards: bool
+) -> List[Record]:
     # sort and direction weren't working as params to get passed so they have to go directly into the query
     # this is fine as they both are sanitized with the api-spec
+    condition, order = keyset(sortby, "id", direction, backwards=backwards, param=2)
     query = f"""
-        SELECT encode(convert_to(cast(id as text), 'UTF8'), 'base64') AS id, owner, name, content, has_password, share_email, private, clicks, creation_date
+        SELECT id, encode(convert_to(cast(id as text), 'UTF8'), 'base64') AS encoded_id, owner, name, content, has_password, share_email, private, clicks, creation_date
         FROM notes
-        WHERE owner = $1
-        ORDER BY {sortby} {direction.upper()}
-        LIMIT 50
-        OFFSET $2
+        WHERE owner = $1 {"AND " + condition if cursor is not None else ""}
+        ORDER BY {order}
+        LIMIT {PAGE_SIZE + 1}
     """
-    return await conn.fetch(query, owner, offset)
+    return await conn.fetch(query, owner, *(cursor or ()))
 
 
 async def select_notes_count(conn: ConnOrPool, *, owner: int) -> int:
-    return await conn.fetchval("SELECT count(id) FROM notes WHERE owner = $1", owner)
+    return await select_counter(conn, name="notes", owner=owner)
 
 
 async def select_total_notes_count(conn: ConnOrPool) -> int:
-    return await conn.fetchval("SELECT count(id) FROM notes")
+    return await select_counter(conn, name="notes")
 
 
-async def select_short_urls(conn: ConnOrPool, *, sortby: str, direction: str, owner: int, offset: int) -> List[Record]:
+async def select_short_urls(
+    conn: ConnOrPool, *, sortby: str, direction: str, owner: int, cursor: Cursor | None, backwards: bool
+) -> List[Record]:
     # sort and direction weren't working as params to get passed so they have to go directly into the query
     # this is fine as they both are sanitized with the api-spec
+    condition, order = keyset(sortby, "alias", direction, backwards=backwards, param=2)
     query = f"""
         SELECT alias, destination, clicks, creation_date
         FROM urls
-        WHERE owner = $1
-        ORDER BY {sortby} {direction.upper()}
-        LIMIT 50
-        OFFSET $2
+        WHERE owner = $1 {"AND " + condition if cursor is not None else ""}
+        ORDER BY {order}
+        LIMIT {PAGE_SIZE + 1}
     """
-    return await conn.fetch(query, owner, offset)
+    return await conn.fetch(query, owner, *(cursor or ()))
 
 
 async def select_short_urls_count(conn: ConnOrPool, *, owner: int) -> int:
-    return await conn.fetchval("SELECT count(alias) FROM urls WHERE owner = $1", owner)
+    return await select_counter(conn, name="urls", owner=owner)
 
 
-async def select_total_short_urls_count(conn: ConnOrPool):
-    return await conn.fetchval("SELECT count(alias) FROM urls")
+async def select_total_short_urls_count(conn: ConnOrPool) -> int:
+    return await select_counter(conn, name="urls")
 
 
 async def insert_short_url(conn: ConnOrPool, *, owner: int, alias: str, destination: str):
-    return await conn.fetchrow(
+    row = await conn.fetchrow(
         "INSERT INTO urls (owner, alias, destination) VALUES ($1, $2, $3)", owner, alias, destination
     )
+    await notify(conn, channel=SHORT_URL_CREATED_CHANNEL, payload=alias)
+    return row
+
+
+async def insert_short_url_if_free(conn: ConnOrPool, *, owner: int, alias: str, destination: str) -> bool:
+    """Insert unless the alias is taken, returns whether the row was inserted"""
+    query = """
+        INSERT INTO urls (owner, alias, destination) VALUES ($1, $2, $3)
+        ON CONFLICT (alias) DO NOTHING
+        RETURNING alias
+    """
+    inserted = await conn.fetchval(query, owner, alias, destination)
+    if inserted is None:
+        return False
+    await notify(conn, channel=SHORT_URL_CREATED_CHANNEL, payload=alias)
+    return True
+
+
+async def insert_short_urls_if_free(
+    conn: ConnOrPool, *, owner: int, aliases: List[str], destinations: List[str]
+) -> List[str]:
+    """Bulk version of `insert_short_url_if_free`, returns the aliases that were inserted"""
+    query = """
+        WITH inserted AS (
+            INSERT INTO urls (owner, alias, destination)
+            SELECT $1, alias, destination FROM unnest($2::text[], $3::text[]) AS c(alias, destination)
+            ON CONFLICT (alias) DO NOTHING
+            RETURNING alias
+        )
+        SELECT alias, pg_notify($4, alias) FROM inserted
+    """
+    rows = await conn.fetch(query, owner, aliases, destinations, SHORT_URL_CREATED_CHANNEL)
+    return [row["alias"] for row in rows]
 
 
 async def update_short_url(conn: ConnOrPool, *, alias: str, new_alias: str, destination: str, reset_clicks: bool):
@@ -74,11 +166,32 @@ async def update_short_url(conn: ConnOrPool, *, alias: str, new_alias: str, dest
     if reset_clicks is True:
         query += ", clicks = 0"
     query += " WHERE alias = $3"
-    return await conn.execute(query, new_alias, destination, alias)
+    status = await conn.execute(query, new_alias, destination, alias)
+    await notify(conn, channel=SHORT_URL_CHANNEL, payload=alias)
+    if new_alias != alias:
+        await notify(conn, channel=SHORT_URL_CREATED_CHANNEL, payload=new_alias)
+    return status
 
 
 async def delete_short_url(conn: ConnOrPool, *, alias: str):
-    return await conn.execute("DELETE FROM urls WHERE alias = $1", alias)
+    status = await conn.execute("DELETE FROM urls WHERE alias = $1", alias)
+    await notify(conn, channel=SHORT_URL_CHANNEL, payload=alias)
+    return status
+
+
+async def iter_short_url_aliases(conn: Connection) -> AsyncIterator[str]:
+    async with conn.transaction():
+        async for record in conn.cursor("SELECT alias FROM urls", prefetch=10_000):
+            yield record["alias"]
+
+
+async def select_free_aliases(conn: ConnOrPool, *, aliases: List[str]) -> List[str]:
+    query = """
+        SELECT candidate
+        FROM unnest($1::text[]) AS candidate
+        WHERE NOT EXISTS (SELECT 1 FROM urls WHERE alias = candidate)
+    """
+    return [row["candidate"] for row in await conn.fetch(query, aliases)]
 
 
 async def select_short_url_exists(conn: ConnOrPool, *, alias: str):
@@ -90,20 +203,117 @@ async def select_short_url_destination(conn: ConnOrPool, *, alias: str):
 
 
 async def select_short_url(conn: ConnOrPool, *, alias: str):
-    return await conn.fetchrow("SELECT owner, alias, destination, clicks FROM urls WHERE alias = $1", alias)
+    return await conn.fetchrow(
+        "SELECT owner, alias, destination, clicks, creation_date FROM urls WHERE alias = $1", alias
+    )
+
 
+async def add_short_url_clicks(conn: ConnOrPool, *, aliases: List[str], counts: List[int]):
+    query = """
+        UPDATE urls
+        SET clicks = urls.clicks + c.count
+        FROM unnest($1::text[], $2::bigint[]) AS c(alias, count)
+        WHERE urls.alias = c.alias
+    """
+    return await conn.execute(query, aliases, counts)
+
+
+async def add_note_clicks(conn: ConnOrPool, *, note_ids: List[UUID], counts: List[int]):
+    query = """
+        UPDATE notes
+        SET clicks = notes.clicks + c.count
+        FROM unnest($1::uuid[], $2::bigint[]) AS c(id, count)
+        WHERE notes.id = c.id
+    """
+    return await conn.execute(query, note_ids, counts)
 
-async def add_short_url_click(conn: ConnOrPool, *, alias: str):
-    return await conn.execute("UPDATE urls SET clicks = clicks + 1 WHERE alias = $1", alias)
+
+async def insert_click_events(conn: ConnOrPool, *, events: List[tuple[str, datetime]]):
+    return await conn.copy_records_to_table("click_events", records=events, columns=["alias", "clicked"])
+
+
+async def create_click_events_partition(conn: ConnOrPool, *, day: date):
+    # DDL can't take parameters, the name and bounds are built from a date so they are safe to format in
+    query = f"""
+        CREATE TABLE IF NOT EXISTS click_events_{day:%Y%m%d}
+        PARTITION OF click_events
+        FOR VALUES FROM ('{day:%Y-%m-%d} 00:00+00') TO ('{day + timedelta(days=1):%Y-%m-%d} 00:00+00')
+    """
+    return await conn.execute(query)
+
+
+async def select_click_events_partitions(conn: ConnOrPool) -> List[str]:
+    query = """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = 'click_events'
+    """
+    return [row["relname"] for row in await conn.fetch(query)]
+
+
+async def drop_click_events_partition(conn: ConnOrPool, *, day: date):
+    return await conn.execute(f"DROP TABLE IF EXISTS click_events_{day:%Y%m%d}")
+
+
+async def select_click_rollup_watermark(conn: ConnOrPool) -> datetime | None:
+    return await conn.fetchval("SELECT rolled_until FROM click_rollup_state")
+
+
+async def rollup_click_events(conn: ConnOrPool, *, since: datetime):
+    """Recompute the hourly and daily buckets from `since` onwards and move the watermark forward"""
+    # buckets are recomputed instead of incremented so running this twice over the same window is harmless
+    hourly = """
+        INSERT INTO click_rollups_hourly (alias, bucket, clicks)
+        SELECT e.alias, date_trunc('hour', e.clicked AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', count(*)
+        FROM click_events e
+        JOIN urls u ON u.alias = e.alias
+        WHERE e.clicked >= date_trunc('hour', $1 AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+        GROUP BY 1, 2
+        ON CONFLICT (alias, bucket) DO UPDATE SET clicks = EXCLUDED.clicks
+    """
+    daily = """
+        INSERT INTO click_rollups_daily (alias, bucket, clicks)
+        SELECT alias, date_trunc('day', bucket AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', sum(clicks)
+        FROM click_rollups_hourly
+        WHERE bucket >= date_trunc('day', $1 AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+        GROUP BY 1, 2
+        ON CONFLICT (alias, bucket) DO UPDATE SET clicks = EXCLUDED.clicks
+    """
+    watermark = """
+        INSERT INTO click_rollup_state (id, rolled_until)
+        VALUES (true, date_trunc('hour', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC')
+        ON CONFLICT (id) DO UPDATE SET rolled_until = EXCLUDED.rolled_until
+    """
+    await conn.execute(hourly, since)
+    await conn.execute(daily, since)
+    await conn.execute(watermark)
+
+
+async def select_click_rollups_hourly(conn: ConnOrPool, *, alias: str, since: datetime) -> List[Record]:
+    return await conn.fetch(
+        "SELECT bucket, clicks FROM click_rollups_hourly WHERE alias = $1 AND bucket >= $2 ORDER BY bucket DESC",
+        alias,
+        since,
+    )
+
+
+async def select_click_rollups_daily(conn: ConnOrPool, *, alias: str, since: datetime) -> List[Record]:
+    return await conn.fetch(
+        "SELECT bucket, clicks FROM click_rollups_daily WHERE alias = $1 AND bucket >= $2 ORDER BY bucket DESC",
+        alias,
+        since,
+    )
 
 
 async def insert_user(conn: ConnOrPool, *, email: str, api_key: str, hashed_password: str):
     query = """
-        INSERT INTO users (email, password, api_key)
-        VALUES ($1, $2, $3)
+        INSERT INTO users (email, password, api_key, api_key_digest)
+        VALUES ($1, $2, $3, $4)
         RETURNING id
     """
-    return await conn.fetchval(query, email, hashed_password, api_key)
+    return await conn.fetchval(query, email, hashed_password, api_key, api_key_digest(api_key))
 
 
 async def update_user(conn: ConnOrPool, *, user_id: int, email: str, session_duration: int):
@@ -112,27 +322,42 @@ async def update_user(conn: ConnOrPool, *, user_id: int, email: str, session_dur
         SET email = $2, session_duration = $3
         WHERE id = $1
     """
-    return await conn.execute(query, user_id, email, session_duration)
+    result = await conn.execute(query, user_id, email, session_duration)
+    await notify_user_changed(conn, user_id=user_id)
+    return result
+
+
+async def update_user_password(conn: ConnOrPool, *, user_id: int, hashed_password: str):
+    result = await conn.execute("UPDATE users SET password = $2 WHERE id = $1", user_id, hashed_password)
+    await notify_user_changed(conn, user_id=user_id)
+    return result
 
 
 async def delete_user(conn: ConnOrPool, *, user_id: int):
-    return await conn.execute("DELETE FROM users WHERE id = $1", user_id)
+    result = await conn.execute("DELETE FROM users WHERE id = $1", user_id)
+    await notify_user_changed(conn, user_id=user_id)
+    return result
 
 
-async def select_users(conn: ConnOrPool, *, sortby: str, direction: str):
+async def select_users(
+    conn: ConnOrPool, *, sortby: str, direction: str, cursor: Cursor | None, backwards: bool
+) -> List[Record]:
+    condition, order = keyset(sortby, "id", direction, backwards=backwards, param=1)
     query = f"""
         SELECT
             id, email, joined
         FROM
             users
-        ORDER BY {sortby} {direction.upper()}
+        {"WHERE " + condition if cursor is not None else ""}
+        ORDER BY {order}
+        LIMIT {PAGE_SIZE + 1}
         """
 
-    return await conn.fetch(query)
+    return await conn.fetch(query, *(cursor or ()))
 
 
-async def select_total_users_count(conn: ConnOrPool):
-    return await conn.fetchval("SELECT count(id) FROM users")
+async def select_total_users_count(conn: ConnOrPool) -> int:
+    return await select_counter(conn, name="users")
 
 
 async def select_user(conn: ConnOrPool, *, user_id: int):
@@ -143,37 +368,88 @@ async def get_hash_and_id_by_email(conn: ConnOrPool, *, email: str):
     return await conn.fetchrow("SELECT id, password FROM users WHERE email = $1", email)
 
 
-async def insert_session(conn: ConnOrPool, *, user_id: int, browser: str, os: str):
+async def select_invite(conn: ConnOrPool, *, code: UUID):
+    return await conn.fetchrow("SELECT used_by, required_email FROM invites WHERE code = $1", code)
+
+
+async def claim_invite(conn: ConnOrPool, *, code: UUID, user_id: int) -> bool:
+    """False if someone else used the invite first"""
+    status = await conn.execute("UPDATE invites SET used_by = $1 WHERE code = $2 AND used_by IS NULL", user_id, code)
+    return status == "UPDATE 1"
+
+
+async def insert_session(conn: ConnOrPool, *, user_id: int, browser: str, os: str) -> Record:
     query = """
         INSERT INTO sessions (token, user_id, browser, os)
         (SELECT gen_random_uuid(), $1, $2, $3)
-        RETURNING token;
+        RETURNING token, expires;
     """  # don't add VALUES before the values, it breaks it
     # I have no idea why but this works
-    return await conn.fetchval(query, user_id, browser, os)
+    return await conn.fetchrow(query, user_id, browser, os)
 
 
 async def delete_session(conn: ConnOrPool, *, token: UUID):
+    # the revoke_sessions trigger notifies every worker
     return await conn.execute("DELETE FROM sessions WHERE token = $1", token)
 
 
-async def select_session_exists(conn: ConnOrPool, *, token: UUID):
-    return await conn.fetchval("SELECT EXISTS(SELECT 1 FROM sessions WHERE token = $1)", token)
+async def select_total_sessions_count(conn: ConnOrPool) -> int:
+    return await select_counter(conn, name="sessions")
 
 
-async def select_total_sessions_count(conn: ConnOrPool):
-    return await conn.fetchval("SELECT count(token) FROM sessions")
+async def select_total_unique_sessions_count(conn: ConnOrPool) -> int:
+    return await conn.fetchval("SELECT count(*) FROM counters WHERE name = 'sessions' AND owner <> 0 AND value > 0")
 
 
-async def select_total_unique_sessions_count(conn: ConnOrPool):
-    return await conn.fetchval("SELECT count(DISTINCT user_id) FROM sessions")
+async def delete_expired_sessions(conn: ConnOrPool, *, limit: int) -> int:
+    """Delete up to `limit` expired sessions, returns how many were deleted"""
+    query = """
+        DELETE FROM sessions
+        WHERE token IN (
+            SELECT token FROM sessions
+            WHERE expires < now()
+            ORDER BY expires
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+    """
+    result = await conn.execute(query, limit)
+    return int(result.split()[-1])
 
 
-async def select_user_by_session(conn: ConnOrPool, *, token: UUID, scopes: QueryScopes):
-    return await conn.fetchrow(
-        f"SELECT {form_scopes(scopes)} FROM users WHERE id = (SELECT user_id FROM sessions WHERE token = $1);",
-        token,
-    )
+async def select_revoked_sessions(conn: ConnOrPool) -> List[Record]:
+    return await conn.fetch("SELECT token, expires FROM revoked_sessions WHERE expires > now()")
+
+
+async def select_user_by_credentials(
+    conn: ConnOrPool, *, token: UUID | None, digest: bytes | None, columns: Iterable[str]
+) -> Record | None:
+    """The user behind a session token or, failing that, an API key digest, in one round trip
+
+    Only `columns` of the user row are selected, plus `session_expires`, which is null for an API key
+    """
+    projection = ", ".join(f"users.{column}" for column in sorted(columns))
+    query = f"""
+        WITH credential AS (
+            -- expired sessions stick around until the sweeper gets to them
+            SELECT user_id, expires FROM sessions WHERE token = $1 AND expires > now()
+            UNION ALL
+            SELECT id, NULL FROM users WHERE api_key_digest = $2
+            LIMIT 1
+        )
+        SELECT {projection}, credential.expires AS session_expires
+        FROM credential
+        JOIN users ON users.id = credential.user_id
+    """
+    return await conn.fetchrow(query, token, digest)
+
+
+async def select_credentials_exist(conn: ConnOrPool, *, token: UUID | None, digest: bytes | None) -> bool:
+    query = """
+        SELECT EXISTS(SELECT 1 FROM sessions WHERE token = $1 AND expires > now())
+            OR EXISTS(SELECT 1 FROM users WHERE api_key_digest = $2)
+    """
+    return await conn.fetchval(query, token, digest)
 
 
 async def select_sessions(conn: ConnOrPool, *, user_id: int):
@@ -182,13 +458,13 @@ async def select_sessions(conn: ConnOrPool, *, user_id: int):
     )
 
 
-async def select_api_key_exists(conn: ConnOrPool, *, api_key: str):
-    return await conn.fetchval("SELECT EXISTS(SELECT 1 FROM users WHERE api_key = $1);", api_key)
+async def select_api_key_exists(conn: ConnOrPool, *, digest: bytes):
+    return await conn.fetchval("SELECT EXISTS(SELECT 1 FROM users WHERE api_key_digest = $1);", digest)
 
 
 async def update_api_key(conn: ConnOrPool, *, user_id: int, api_key: str):
-    return await conn.execute("UPDATE users SET api_key = $2 WHERE id = $1", user_id, api_key)
-
-
-async def select_user_by_api_key(conn: ConnOrPool, *, api_key: str, scopes: QueryScopes):
-    return await conn.fetchrow(f"SELECT {form_scopes(scopes)} FROM users WHERE api_key = $1", api_key)
+    result = await conn.execute(
+        "UPDATE users SET api_key = $2, api_key_digest = $3 WHERE id = $1", user_id, api_key, api_key_digest(api_key)
+    )
+    await notify_user_changed(conn, user_id=user_id)
+    return result
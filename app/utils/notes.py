@@ -0,0 +1,110 @@
+"""Password protected note encryption
+
+Keys are derived with 100,000 PBKDF2 iterations, so that happens in the password hasher's process pool and
+recently derived keys are cached to let repeat views of a shared note skip it
+"""
+
+import base64
+import os
+from hashlib import blake2b
+from uuid import UUID
+
+from aiohttp import web
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from app.utils.cache import LRUCache, register_cache
+from app.utils.passwords import PASSWORD_HASHER_KEY
+
+NOTE_KEYS_KEY = "note_keys"
+
+SALT_LENGTH = 32
+KDF_ITERATIONS = 100_000
+
+
+def derive_key(salt: bytes, password: bytes) -> bytes:
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS, backend=default_backend()
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+
+def split_salt_and_content(stored: bytes) -> tuple[bytes, bytes]:
+    return stored[:SALT_LENGTH], stored[SALT_LENGTH:]
+
+
+# these run in the worker processes, deriving and using the key in one call saves a round trip
+
+
+def _encrypt(salt: bytes, password: bytes, content: bytes) -> tuple[bytes, bytes]:
+    key = derive_key(salt, password)
+    return key, Fernet(key).encrypt(content)
+
+
+def _decrypt(salt: bytes, password: bytes, token: bytes) -> tuple[bytes, bytes | None]:
+    key = derive_key(salt, password)
+    try:
+        return key, Fernet(key).decrypt(token)
+    except InvalidToken:
+        return key, None
+
+
+class NoteKeys:
+    """Derived keys of recently opened notes
+
+    Entries are keyed on a digest of the note id and password under a per process secret, so neither the
+    password nor anything that could be brute forced offline sits in memory
+    """
+
+    def __init__(self, cache: LRUCache[bytes, bytes]) -> None:
+        self.cache = cache
+        self._secret = os.urandom(32)
+
+    def _digest(self, note_id: UUID, password: bytes) -> bytes:
+        return blake2b(note_id.bytes + password, key=self._secret).digest()
+
+    def get(self, note_id: UUID, password: bytes) -> bytes | None:
+        return self.cache.get(self._digest(note_id, password))
+
+    def set(self, note_id: UUID, password: bytes, key: bytes) -> None:
+        self.cache.set(self._digest(note_id, password), key)
+
+    def discard(self, note_id: UUID, password: bytes) -> None:
+        self.cache.pop(self._digest(note_id, password))
+
+
+async def encrypt_note(app: web.Application, *, content: str, password: str) -> tuple[bytes, bytes]:
+    """Returns what gets stored for the note and the key it was encrypted with"""
+    salt = os.urandom(SALT_LENGTH)
+    key, token = await app[PASSWORD_HASHER_KEY].submit(_encrypt, salt, password.encode(), content.encode())
+    return salt + token, key
+
+
+async def decrypt_note(app: web.Application, *, note_id: UUID, stored: bytes, password: str) -> str | None:
+    """Returns None if the password is wrong"""
+    keys: NoteKeys = app[NOTE_KEYS_KEY]
+    salt, token = split_salt_and_content(stored)
+
+    key = keys.get(note_id, password.encode())
+    if key is not None:
+        # with the key already derived, decrypting a note is a few microseconds, less than sending it to the pool
+        try:
+            return Fernet(key).decrypt(token).decode("utf-8")
+        except InvalidToken:
+            # the note was encrypted again since the key was cached, derive it from the current salt
+            keys.discard(note_id, password.encode())
+
+    key, content = await app[PASSWORD_HASHER_KEY].submit(_decrypt, salt, password.encode(), token)
+    if content is None:
+        return None
+
+    keys.set(note_id, password.encode(), key)
+    return content.decode("utf-8")
+
+
+def setup_note_keys(app: web.Application) -> None:
+    config = app["config"].get("cache", {}).get("note_keys", {})
+    cache: LRUCache[bytes, bytes] = LRUCache(maxsize=config.get("size", 1000), ttl=config.get("ttl", 300))
+    app[NOTE_KEYS_KEY] = NoteKeys(register_cache(app, "note_keys", cache))
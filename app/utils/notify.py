@@ -0,0 +1,112 @@
+"""Cross-worker invalidation through postgres LISTEN/NOTIFY"""
+
+import asyncio
+from collections import defaultdict
+from contextlib import suppress
+from typing import Awaitable, Callable
+
+import sentry_sdk
+from aiohttp import web
+from asyncpg import Connection, connect
+
+LISTENER_KEY = "db_listener"
+
+SHORT_URL_CHANNEL = "short_url_invalidate"
+SHORT_URL_CREATED_CHANNEL = "short_url_created"
+# payload is "token:<session token>" or "user:<user id>"
+SESSION_CHANNEL = "session_invalidate"
+# payload is the id of the user whose urls or notes changed
+DATA_VERSION_CHANNEL = "data_version"
+
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+
+class Listener:
+    """The LISTEN connection, reconnected whenever it drops
+
+    Notifications sent while it was down are lost, so everything that relies on them registers a callback with
+    `on_reconnect` to throw away what may have gone stale
+    """
+
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+        self.connection: Connection | None = None
+        self._channels: defaultdict[str, list[Callable[[str], None]]] = defaultdict(list)
+        self._reconnect_callbacks: list[Callable[[], Awaitable[None]]] = []
+        self._reconnecting: asyncio.Task | None = None
+        self._closed = False
+        self.reconnects = 0
+
+    def _dispatch(self, _conn: Connection, _pid: int, channel: str, payload: str) -> None:
+        for callback in self._channels[channel]:
+            callback(payload)
+
+    async def connect(self) -> None:
+        # LISTEN needs a connection of its own, a pooled one would be handed out to queries
+        connection = await connect(dsn=self.dsn)
+        connection.add_termination_listener(self._terminated)
+        for channel in self._channels:
+            await connection.add_listener(channel, self._dispatch)
+        self.connection = connection
+
+    async def listen(self, channel: str, callback: Callable[[str], None]) -> None:
+        if channel not in self._channels and self.connection is not None:
+            await self.connection.add_listener(channel, self._dispatch)
+        self._channels[channel].append(callback)
+
+    def on_reconnect(self, callback: Callable[[], Awaitable[None]]) -> None:
+        self._reconnect_callbacks.append(callback)
+
+    def _terminated(self, _conn: Connection) -> None:
+        if self._closed or self._reconnecting is not None:
+            return
+        self.connection = None
+        self._reconnecting = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = RECONNECT_DELAY
+        try:
+            while True:
+                try:
+                    await self.connect()
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    sentry_sdk.capture_exception()
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            self._reconnecting = None
+
+        self.reconnects += 1
+        for callback in self._reconnect_callbacks:
+            try:
+                await callback()
+            except Exception:  # pylint: disable=broad-except
+                sentry_sdk.capture_exception()
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._reconnecting
+        if self.connection is not None:
+            await self.connection.close()
+
+
+async def setup_listener(app: web.Application) -> Listener:
+    listener = Listener(app["config"]["postgres_dsn"])
+    await listener.connect()
+    app[LISTENER_KEY] = listener
+    return listener
+
+
+async def listen(app: web.Application, channel: str, callback: Callable[[str], None]) -> None:
+    """Call `callback` with the payload of every notification sent on `channel`"""
+    await app[LISTENER_KEY].listen(channel, callback)
+
+
+def on_reconnect(app: web.Application, callback: Callable[[], Awaitable[None]]) -> None:
+    """Call `callback` once the listener is back after losing its connection, and with it any notifications"""
+    app[LISTENER_KEY].on_reconnect(callback)
@@ -0,0 +1,121 @@
+"""Keyset (cursor) pagination helpers
+
+A cursor is the sort value and tiebreaker of the row at the edge of a page, so the next page starts right
+after it in the index instead of counting its way there with OFFSET.
+"""
+
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+from uuid import UUID
+
+import orjson
+from asyncpg import Record
+
+PAGE_SIZE = 50
+
+# how to turn a value that went through json back into what asyncpg expects for that column type
+DECODERS: dict[type, Callable[[Any], Any]] = {
+    datetime: datetime.fromisoformat,
+    UUID: UUID,
+}
+
+# every int sort column is a bigint or smaller
+BIGINT_MIN = -(2**63)
+BIGINT_MAX = 2**63 - 1
+
+Cursor = Tuple[Any, Any]
+
+
+class Page(NamedTuple):
+    rows: List[Record]
+    next_cursor: Optional[str]
+    prev_cursor: Optional[str]
+
+
+def encode_cursor(sortby: str, direction: str, value: Any, tiebreaker: Any) -> str:
+    # asyncpg's own UUID type isn't one orjson knows about
+    return urlsafe_b64encode(orjson.dumps([sortby, direction, value, tiebreaker], default=str)).decode()
+
+
+def decode_cursor(token: str, *, sortby: str, direction: str, columns: dict[str, type], tiebreaker: str) -> Cursor:
+    """Raises ValueError if the token is malformed or was made for a different sort"""
+    try:
+        token_sortby, token_direction, value, tiebreaker_value = orjson.loads(urlsafe_b64decode(token.encode()))
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError) as error:
+        raise ValueError("Invalid cursor") from error
+
+    if token_sortby != sortby or token_direction != direction:
+        raise ValueError("Cursor doesn't match the current sort")
+
+    return decode_value(columns[sortby], value), decode_value(columns[tiebreaker], tiebreaker_value)
+
+
+def decode_value(column_type: type, raw: Any) -> Any:
+    """Raises ValueError if `raw` can't be what a column of that type holds, asyncpg would fail on it mid query"""
+    decoder = DECODERS.get(column_type)
+    if decoder is not None:
+        if not isinstance(raw, str):
+            raise ValueError("Invalid cursor")
+        return decoder(raw)
+
+    # type() and not isinstance, json true and false would pass for an int column
+    if type(raw) is not column_type:  # pylint: disable=unidiomatic-typecheck
+        raise ValueError("Invalid cursor")
+    if column_type is int and not BIGINT_MIN <= raw <= BIGINT_MAX:
+        raise ValueError("Invalid cursor")
+    if column_type is str and "\x00" in raw:
+        # postgres text can't hold it
+        raise ValueError("Invalid cursor")
+    return raw
+
+
+def read_cursor(
+    querystring: dict[str, Any], *, sortby: str, direction: str, columns: dict[str, type], tiebreaker: str
+) -> Tuple[Optional[Cursor], bool]:
+    """Returns the cursor from the `after` or `before` query parameter and whether the page goes backwards
+
+    A cursor that can't be used just starts from the first page
+    """
+    for key, backwards in (("after", False), ("before", True)):
+        token = querystring.get(key)
+        if token:
+            try:
+                return (
+                    decode_cursor(token, sortby=sortby, direction=direction, columns=columns, tiebreaker=tiebreaker),
+                    backwards,
+                )
+            except ValueError:
+                break
+    return None, False
+
+
+def build_page(
+    rows: List[Record],
+    *,
+    sortby: str,
+    direction: str,
+    tiebreaker: str,
+    cursor: Optional[Cursor],
+    backwards: bool,
+) -> Page:
+    """Turn the PAGE_SIZE + 1 rows a keyset query fetched into a page with cursors to its neighbours"""
+    has_more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if backwards:
+        # backwards pages are fetched in reverse order
+        rows = rows[::-1]
+
+    if not rows:
+        return Page(rows, None, None)
+
+    has_next = cursor is not None if backwards else has_more
+    has_prev = has_more if backwards else cursor is not None
+
+    first, last = rows[0], rows[-1]
+    return Page(
+        rows,
+        encode_cursor(sortby, direction, last[sortby], last[tiebreaker]) if has_next else None,
+        encode_cursor(sortby, direction, first[sortby], first[tiebreaker]) if has_prev else None,
+    )
@@ -0,0 +1,88 @@
+"""Password hashing and other key derivation in a process pool so PBKDF2 doesn't block the event loop"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Type
+
+from aiohttp import web
+from passlib.hash import pbkdf2_sha512
+from passlib.utils.handlers import GenericHandler
+
+PASSWORD_HASHER_KEY = "password_hasher"
+
+DEFAULT_ROUNDS = pbkdf2_sha512.default_rounds
+# every app worker starts a pool of its own, one process per cpu each would oversubscribe the machine
+DEFAULT_WORKERS = 2
+
+
+def password_handler(rounds: int = DEFAULT_ROUNDS) -> Type[GenericHandler]:
+    """pbkdf2_sha512 hashing with `rounds`, hashes made with fewer rounds need an update"""
+    return pbkdf2_sha512.using(rounds=rounds, min_desired_rounds=rounds)
+
+
+# these run in the worker processes so they have to be picklable module level functions
+
+
+def _hash(password: str, rounds: int) -> str:
+    return password_handler(rounds).hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pbkdf2_sha512.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    def __init__(self, *, workers: int, max_pending: int, rounds: int) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.handler = password_handler(rounds)
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._pending = 0
+
+    async def start(self) -> None:
+        # with fork every worker is started on the first submit, do it now while there are no connections or
+        # background tasks in this process to duplicate
+        await asyncio.get_running_loop().run_in_executor(self._executor, int)
+
+    async def submit(self, function, *args: Any) -> Any:
+        """Run a picklable module level `function` in the pool, raises HTTPServiceUnavailable when it's saturated"""
+        # a flood of logins would otherwise queue up seconds of hashing, answering 503 right away is kinder
+        if self._pending >= self.max_pending:
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self.submit(_hash, password, self.rounds)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self.submit(_verify, password, hashed_password)
+
+    def needs_update(self, hashed_password: str) -> bool:
+        """If the hash was made with fewer rounds than are configured now, only parses the hash"""
+        return self.handler.needs_update(hashed_password)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def setup_password_hasher(app: web.Application) -> None:
+    config = app["config"].get("passwords", {})
+    workers = config.get("workers") or DEFAULT_WORKERS
+    hasher = PasswordHasher(
+        workers=workers,
+        max_pending=config.get("max_pending", workers * 4),
+        rounds=config.get("rounds", DEFAULT_ROUNDS),
+    )
+    await hasher.start()
+    app[PASSWORD_HASHER_KEY] = hasher
+
+    async def close(_: web.Application) -> None:
+        hasher.close()
+
+    app.on_cleanup.append(close)
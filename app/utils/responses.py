@@ -0,0 +1,9 @@
+from typing import Any
+
+import orjson
+from aiohttp import web
+
+
+def json_response(data: Any, *, status: int = 200, headers: dict[str, str] | None = None) -> web.Response:
+    """Like `web.json_response` but encoded with orjson, which also handles datetimes and UUIDs"""
+    return web.Response(body=orjson.dumps(data), status=status, headers=headers, content_type="application/json")
@@ -0,0 +1,112 @@
+"""Per worker caches of the user row behind a session token or API key for verify_user"""
+
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Any, Iterable, Mapping
+from uuid import UUID
+
+from aiohttp import web
+
+from app.utils.cache import LRUCache, register_cache
+from app.utils.db import (
+    api_key_digest,
+    get_db,
+    select_credentials_exist,
+    select_user_by_credentials,
+)
+from app.utils.notify import SESSION_CHANNEL, listen, on_reconnect
+from app.utils.signed_sessions import SESSION_SIGNER_KEY
+
+SESSION_CACHE_KEY = "session_cache"
+API_KEY_CACHE_KEY = "api_key_cache"
+
+# id is what forget_user matches cached users on and admin is checked by verify_user whatever the route's scopes
+ALWAYS_SELECTED = frozenset({"id", "admin"})
+
+
+async def get_user(
+    app: web.Application, *, token: UUID | None, api_key: str | None, scopes: Iterable[str]
+) -> Mapping[str, Any] | None:
+    """The columns `scopes` asks for of the user behind a session token or API key, the token wins if both work"""
+    session_cache: LRUCache[UUID, Mapping[str, Any]] = app[SESSION_CACHE_KEY]
+    api_key_cache: LRUCache[bytes, Mapping[str, Any]] = app[API_KEY_CACHE_KEY]
+
+    # keyed on the digest so the plaintext key isn't kept around any longer than the request
+    digest = api_key_digest(api_key) if api_key is not None else None
+    columns = ALWAYS_SELECTED.union(scopes)
+
+    for cache, key in ((session_cache, token), (api_key_cache, digest)):
+        if key is None:
+            continue
+        user = cache.get(key)
+        if user is not None:
+            if columns.issubset(user):
+                return user
+            # another route cached fewer columns, fetch theirs too so the entry serves both from now on
+            columns = columns.union(user)
+
+    row = await select_user_by_credentials(get_db(app), token=token, digest=digest, columns=columns)
+    if row is None:
+        return None
+
+    user = MappingProxyType({column: row[column] for column in columns})
+    if row["session_expires"] is not None:
+        # never keep a session around for longer than it's valid
+        remaining = (row["session_expires"] - datetime.now(timezone.utc)).total_seconds()
+        if remaining > 0:
+            session_cache.set(token, user, ttl=remaining)
+    else:
+        api_key_cache.set(digest, user)
+
+    return user
+
+
+async def user_exists(app: web.Application, *, token: UUID | None, api_key: str | None) -> bool:
+    """Whether either credential belongs to a user, without reading the user"""
+    digest = api_key_digest(api_key) if api_key is not None else None
+    if token is not None and app[SESSION_CACHE_KEY].get(token) is not None:
+        return True
+    if digest is not None and app[API_KEY_CACHE_KEY].get(digest) is not None:
+        return True
+    return await select_credentials_exist(get_db(app), token=token, digest=digest)
+
+
+# the database functions that change users or sessions notify every worker, these are for the worker handling the
+# request to drop its copy right away, before the redirect that follows can read it
+def forget_session(app: web.Application, token: UUID) -> None:
+    app[SESSION_CACHE_KEY].pop(token)
+    if SESSION_SIGNER_KEY in app:
+        app[SESSION_SIGNER_KEY].revoke(token)
+
+
+def forget_user(app: web.Application, user_id: int) -> None:
+    app[SESSION_CACHE_KEY].pop_where(lambda user: user["id"] == user_id)
+    app[API_KEY_CACHE_KEY].pop_where(lambda user: user["id"] == user_id)
+
+
+async def setup_session_cache(app: web.Application) -> None:
+    config = app["config"].get("cache", {}).get("sessions", {})
+    cache: LRUCache[UUID, Mapping[str, Any]] = LRUCache(maxsize=config.get("size", 10_000), ttl=config.get("ttl", 60))
+    app[SESSION_CACHE_KEY] = register_cache(app, "sessions", cache)
+
+    config = app["config"].get("cache", {}).get("api_keys", {})
+    api_key_cache: LRUCache[bytes, Mapping[str, Any]] = LRUCache(
+        maxsize=config.get("size", 1000), ttl=config.get("ttl", 300)
+    )
+    app[API_KEY_CACHE_KEY] = register_cache(app, "api_keys", api_key_cache)
+
+    def invalidate(payload: str) -> None:
+        kind, _, value = payload.partition(":")
+        if kind == "token":
+            forget_session(app, UUID(value))
+        elif kind == "user":
+            forget_user(app, int(value))
+
+    await listen(app, SESSION_CHANNEL, invalidate)
+
+    async def reconnected() -> None:
+        # a logout or revoked session may have been missed
+        cache.clear()
+        api_key_cache.clear()
+
+    on_reconnect(app, reconnected)
@@ -1,14 +1,279 @@
+import asyncio
 import string
+from collections import deque
+from contextlib import suppress
 from secrets import choice
+from typing import Any
 
-from app.utils.db import ConnOrPool, select_short_url_exists
+import sentry_sdk
+from aiohttp import web
+from asyncpg import UniqueViolationError
+
+from app.utils.bloom import BloomFilter
+from app.utils.cache import LRUCache, register_cache
+from app.utils.db import (
+    get_db,
+    insert_short_url_if_free,
+    insert_short_urls_if_free,
+    iter_short_url_aliases,
+    select_free_aliases,
+    select_short_url_destination,
+    select_total_short_urls_count,
+    update_short_url,
+)
+from app.utils.notify import SHORT_URL_CHANNEL, SHORT_URL_CREATED_CHANNEL, listen, on_reconnect
 
 ALPHANUMERIC_CHARS = string.ascii_letters + string.digits
 
+SHORT_URL_CACHE_KEY = "short_url_cache"
+ALIAS_FILTER_KEY = "alias_filter"
+ALIAS_POOL_KEY = "alias_pool"
+
+ALIAS_LENGTH = 7
+
+
+def random_alias() -> str:
+    return "".join(choice(ALPHANUMERIC_CHARS) for _ in range(ALIAS_LENGTH))
+
+
+class AliasFilter:
+    """Bloom filter of every existing alias so unknown aliases can be answered without a query
+
+    Deletes can't be removed from a bloom filter, so it is rebuilt from the database every `rebuild_interval`
+    """
+
+    def __init__(self, app: web.Application, *, capacity: int, false_positive_rate: float) -> None:
+        self.app = app
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.filter = BloomFilter(capacity, false_positive_rate)
+        self._added_during_rebuild: list[str] | None = None
+        # the scheduled rebuild and the one after a reconnect could otherwise overlap
+        self._rebuild_lock = asyncio.Lock()
+
+        self.rejected = 0
+        self.passed = 0
+        self.false_positives = 0
+        self.rebuilds = 0
+
+    def add(self, alias: str) -> None:
+        self.filter.add(alias)
+        if self._added_during_rebuild is not None:
+            self._added_during_rebuild.append(alias)
+
+    def __contains__(self, alias: str) -> bool:
+        if alias in self.filter:
+            self.passed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    async def rebuild(self) -> None:
+        async with self._rebuild_lock:
+            self._added_during_rebuild = []
+            try:
+                async with get_db(self.app).acquire() as conn:
+                    count = await select_total_short_urls_count(conn)
+                    # leave some headroom so new aliases don't push the false positive rate up before the next rebuild
+                    new = BloomFilter(max(self.capacity, count * 2), self.false_positive_rate)
+                    async for alias in iter_short_url_aliases(conn):
+                        new.add(alias)
+                # aliases created while the table was being read may have been missed by the snapshot
+                new.update(self._added_during_rebuild)
+                self.filter = new
+                self.rebuilds += 1
+            finally:
+                self._added_during_rebuild = None
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.rebuild()
+            except Exception:  # pylint: disable=broad-except
+                sentry_sdk.capture_exception()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            **self.filter.stats(),
+            "rejected": f"{self.rejected:,}",
+            "passed": f"{self.passed:,}",
+            "false_positives": f"{self.false_positives:,}",
+            "rebuilds": f"{self.rebuilds:,}",
+        }
+
+
+class AliasPool:
+    """Random aliases that were free when they were generated, refilled in bulk in the background
+
+    An alias can still be taken by the time it is used, so it has to be inserted with `insert_short_url_if_free`
+    """
+
+    def __init__(self, app: web.Application, *, size: int, refill_at: int) -> None:
+        self.app = app
+        self.size = size
+        self.refill_at = refill_at
+        self._aliases: deque[str] = deque()
+        self._low = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._aliases)
+
+    def take(self) -> str:
+        if len(self._aliases) <= self.refill_at:
+            self._low.set()
+        if not self._aliases:
+            # the pool ran dry, a fresh alias is almost certainly free and the insert will retry if it isn't
+            return random_alias()
+        return self._aliases.popleft()
+
+    async def refill(self) -> None:
+        candidates = list({random_alias() for _ in range(self.size - len(self._aliases))})
+        if candidates:
+            self._aliases.extend(await select_free_aliases(get_db(self.app), aliases=candidates))
+
+    async def run(self) -> None:
+        while True:
+            await self._low.wait()
+            self._low.clear()
+            try:
+                await self.refill()
+            except Exception:  # pylint: disable=broad-except
+                sentry_sdk.capture_exception()
+
+
+async def setup_alias_pool(app: web.Application) -> None:
+    config = app["config"].get("alias_pool", {})
+    pool = AliasPool(app, size=config.get("size", 1000), refill_at=config.get("refill_at", 250))
+    await pool.refill()
+    app[ALIAS_POOL_KEY] = pool
+
+    task = asyncio.create_task(pool.run())
+
+    async def close(_: web.Application) -> None:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    app.on_cleanup.append(close)
 
-async def generate_url_alias(conn: ConnOrPool) -> str:
+
+def remember_alias(app: web.Application, alias: str) -> None:
+    """Add an alias this worker just created to its filter
+
+    The short_url_created notification gets here too, but only after the response that links to the alias may have
+    been sent, and a visit before that would be answered with a 404
+    """
+    app[ALIAS_FILTER_KEY].add(alias)
+
+
+async def create_short_url(app: web.Application, *, owner: int, destination: str) -> str:
+    """Create a short url with a random alias, usually a single insert"""
+    pool: AliasPool = app[ALIAS_POOL_KEY]
+    while True:
+        alias = pool.take()
+        if await insert_short_url_if_free(get_db(app), owner=owner, alias=alias, destination=destination):
+            remember_alias(app, alias)
+            return alias
+
+
+async def update_short_url_to_random_alias(
+    app: web.Application, *, alias: str, destination: str, reset_clicks: bool
+) -> str:
+    """Move a short url to a random alias, retrying with the next one if it was taken in the meantime"""
+    pool: AliasPool = app[ALIAS_POOL_KEY]
     while True:
-        alias = "".join(choice(ALPHANUMERIC_CHARS) for _ in range(7))
-        if await select_short_url_exists(conn, alias=alias) is False:
-            break
-    return alias
+        new_alias = pool.take()
+        try:
+            await update_short_url(
+                get_db(app), alias=alias, new_alias=new_alias, destination=destination, reset_clicks=reset_clicks
+            )
+        except UniqueViolationError:
+            continue
+        remember_alias(app, new_alias)
+        return new_alias
+
+
+async def setup_short_url_cache(app: web.Application) -> None:
+    config = app["config"].get("cache", {}).get("short_urls", {})
+    cache: LRUCache[str, str] = LRUCache(maxsize=config.get("size", 10_000), ttl=config.get("ttl", 300))
+    app[SHORT_URL_CACHE_KEY] = register_cache(app, "short_urls", cache)
+
+    # update_short_url and delete_short_url notify with the old alias, so every worker drops it
+    await listen(app, SHORT_URL_CHANNEL, cache.pop)
+
+    async def reconnected() -> None:
+        # an edit or delete may have been missed
+        cache.clear()
+
+    on_reconnect(app, reconnected)
+
+
+async def setup_alias_filter(app: web.Application) -> None:
+    config = app["config"].get("alias_filter", {})
+    alias_filter = AliasFilter(
+        app,
+        capacity=config.get("capacity", 1_000_000),
+        false_positive_rate=config.get("false_positive_rate", 0.001),
+    )
+    await listen(app, SHORT_URL_CREATED_CHANNEL, alias_filter.add)
+    # aliases created by other workers while the listener was down would be 404s until the next scheduled rebuild
+    on_reconnect(app, alias_filter.rebuild)
+    await alias_filter.rebuild()
+    app[ALIAS_FILTER_KEY] = alias_filter
+
+    task = asyncio.create_task(alias_filter.run(config.get("rebuild_interval", 3600)))
+
+    async def close(_: web.Application) -> None:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    app.on_cleanup.append(close)
+
+
+async def get_short_url_destination(app: web.Application, alias: str) -> str | None:
+    cache: LRUCache[str, str] = app[SHORT_URL_CACHE_KEY]
+
+    destination = cache.get(alias)
+    if destination is None:
+        alias_filter: AliasFilter = app[ALIAS_FILTER_KEY]
+        if alias not in alias_filter:
+            return None
+
+        destination = await select_short_url_destination(get_db(app), alias=alias)
+        if destination is None:
+            alias_filter.false_positives += 1
+        else:
+            cache.set(alias, destination)
+
+    return destination
+
+
+async def create_short_urls(app: web.Application, *, owner: int, destinations: list[str]) -> list[str]:
+    """Create a short url with a random alias for every destination, returns the aliases in the same order"""
+    pool: AliasPool = app[ALIAS_POOL_KEY]
+    aliases: list[str] = [""] * len(destinations)
+    pending = list(range(len(destinations)))
+
+    async with get_db(app).acquire() as conn:
+        while pending:
+            candidates = [pool.take() for _ in pending]
+            inserted = set(
+                await insert_short_urls_if_free(
+                    conn, owner=owner, aliases=candidates, destinations=[destinations[i] for i in pending]
+                )
+            )
+
+            retry = []
+            for index, alias in zip(pending, candidates):
+                if alias in inserted:
+                    aliases[index] = alias
+                    remember_alias(app, alias)
+                    # the same candidate twice in one batch only gets inserted once
+                    inserted.discard(alias)
+                else:
+                    retry.append(index)
+            pending = retry
+
+    return aliases
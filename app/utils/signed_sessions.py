@@ -0,0 +1,152 @@
+"""Optional stateless session cookies
+
+The cookie carries the session id, user id, admin flag and expiry under an HMAC, so requests that only need those
+are authenticated without a query. The session row is still created, it's what the sessions page lists and what
+revoking a session deletes. Deleting it records the token in `revoked_sessions`, which every worker keeps a copy of.
+"""
+
+import asyncio
+import binascii
+import hmac
+import struct
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from contextlib import suppress
+from datetime import datetime
+from hashlib import sha256
+from math import inf
+from time import time
+from typing import Any, NamedTuple
+from uuid import UUID
+
+import sentry_sdk
+from aiohttp import web
+
+from app.utils.db import get_db, select_revoked_sessions
+from app.utils.notify import SESSION_CHANNEL, listen, on_reconnect
+
+SESSION_SIGNER_KEY = "session_signer"
+
+# scopes a signed cookie can answer on its own, anything else needs the user row
+TOKEN_SCOPES = frozenset({"id", "admin"})
+
+# session id, user id, admin, expiry as a unix timestamp
+PAYLOAD = struct.Struct(">16sQ?Q")
+MAC_LENGTH = 32
+
+
+class SessionClaims(NamedTuple):
+    session: UUID
+    user_id: int
+    admin: bool
+    expires: int
+
+
+class SessionSigner:
+    def __init__(self, app: web.Application, *, secret: bytes) -> None:
+        self.app = app
+        self._secret = secret
+        # session id -> unix expiry, a revoked token only has to be remembered until it would have expired anyway
+        self._revoked: dict[UUID, float] = {}
+        self._revoked_during_sync: list[UUID] | None = None
+
+    def _mac(self, payload: bytes) -> bytes:
+        return hmac.new(self._secret, payload, sha256).digest()
+
+    def sign(self, *, session: UUID, user_id: int, admin: bool, expires: datetime) -> str:
+        payload = PAYLOAD.pack(session.bytes, user_id, admin, int(expires.timestamp()))
+        # without the padding, = would get the cookie value quoted
+        return urlsafe_b64encode(payload + self._mac(payload)).rstrip(b"=").decode()
+
+    def verify(self, token: str) -> SessionClaims | None:
+        """The claims of a validly signed, unexpired and unrevoked token"""
+        try:
+            raw = urlsafe_b64decode(token.encode() + b"=" * (-len(token) % 4))
+        except (binascii.Error, ValueError):
+            return None
+        if len(raw) != PAYLOAD.size + MAC_LENGTH:
+            return None
+
+        payload, mac = raw[: PAYLOAD.size], raw[PAYLOAD.size :]
+        if not hmac.compare_digest(mac, self._mac(payload)):
+            return None
+
+        session, user_id, admin, expires = PAYLOAD.unpack(payload)
+        claims = SessionClaims(UUID(bytes=session), user_id, admin, expires)
+        if claims.expires <= time() or claims.session in self._revoked:
+            return None
+        return claims
+
+    def revoke(self, session: UUID) -> None:
+        # the expiry isn't in the notification, the next sync fills it in from revoked_sessions
+        self._revoked[session] = inf
+        if self._revoked_during_sync is not None:
+            self._revoked_during_sync.append(session)
+
+    async def sync(self) -> None:
+        self._revoked_during_sync = []
+        try:
+            rows = await select_revoked_sessions(get_db(self.app))
+            revoked = {row["token"]: row["expires"].timestamp() for row in rows}
+            # revocations that arrived while the table was being read may not be in the snapshot
+            for session in self._revoked_during_sync:
+                revoked.setdefault(session, inf)
+            self._revoked = revoked
+        finally:
+            self._revoked_during_sync = None
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception:  # pylint: disable=broad-except
+                sentry_sdk.capture_exception()
+
+    def stats(self) -> dict[str, Any]:
+        return {"revoked": f"{len(self._revoked):,}"}
+
+
+def session_id(app: web.Application, cookie: str) -> UUID | None:
+    """The session id behind a `_session` cookie, whichever kind it is"""
+    signer: SessionSigner | None = app.get(SESSION_SIGNER_KEY)
+    if signer is not None:
+        claims = signer.verify(cookie)
+        if claims is not None:
+            return claims.session
+    try:
+        return UUID(cookie)
+    except ValueError:
+        return None
+
+
+async def setup_signed_sessions(app: web.Application) -> None:
+    config = app["config"].get("signed_sessions", {})
+    if not config.get("enabled", False):
+        return
+
+    if not config.get("secret"):
+        # every worker has to sign with the same secret, so a random one can't be made up here
+        raise ValueError("signed_sessions.secret has to be set to use signed sessions")
+
+    signer = SessionSigner(app, secret=config["secret"].encode())
+
+    def revoke(payload: str) -> None:
+        # deleting a session row notifies with its token, see revoke_sessions() in schema.sql
+        kind, _, value = payload.partition(":")
+        if kind == "token":
+            signer.revoke(UUID(value))
+
+    await listen(app, SESSION_CHANNEL, revoke)
+    # revocations sent while the listener was down are in revoked_sessions
+    on_reconnect(app, signer.sync)
+    await signer.sync()
+    app[SESSION_SIGNER_KEY] = signer
+
+    task = asyncio.create_task(signer.run(config.get("sync_interval", 60)))
+
+    async def close(_: web.Application) -> None:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    app.on_cleanup.append(close)
@@ -0,0 +1,84 @@
+"""Serves the esbuild output in dist
+
+scripts/build.mjs gives every file a content hash in its name, writes `.br` and `.gz` copies next to it and maps the
+unhashed output names, the ones templates pass to `url_for`, to the hashed ones in dist/manifest.json. Hashed files
+never change, so browsers are told to keep them for good. Without a manifest, like in a checkout that was never built,
+files are served under their own names and revalidated every time.
+"""
+
+import os
+from pathlib import Path
+
+import orjson
+from aiohttp import web
+
+from app.routing import compile_handler, fast_path
+
+STATIC_ASSETS_KEY = "static_assets"
+
+STATIC_DIR = "dist"
+MANIFEST_NAME = "manifest.json"
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class StaticAssets:
+    def __init__(self, directory: str, *, rescan: bool) -> None:
+        self.directory = Path(directory)
+        # in dev `just watch` rebuilds while the app runs
+        self.rescan = rescan
+        self.manifest: dict[str, str] = {}
+        self.files: dict[str, Path] = {}
+        self.hashed: frozenset[str] = frozenset()
+        self.load()
+
+    def load(self) -> None:
+        manifest_path = self.directory / MANIFEST_NAME
+        self.manifest = orjson.loads(manifest_path.read_bytes()) if manifest_path.is_file() else {}
+        self.hashed = frozenset(self.manifest.values())
+
+        # only what's in here can be requested, so a path never has to be resolved against the filesystem
+        files = {}
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = Path(root, name)
+                if path.suffix not in {".br", ".gz"} and name != MANIFEST_NAME:
+                    files[path.relative_to(self.directory).as_posix()] = path
+        self.files = files
+
+    def url(self, filename: str) -> str:
+        if self.rescan:
+            self.load()
+        return f"/static/{self.manifest.get(filename, filename)}"
+
+    def response(self, filename: str) -> web.FileResponse:
+        if self.rescan:
+            self.load()
+        path = self.files.get(filename)
+        if path is None:
+            raise web.HTTPNotFound()
+
+        # FileResponse sends the .br or .gz copy instead if the client accepts it
+        return web.FileResponse(
+            path,
+            headers={
+                "Cache-Control": IMMUTABLE if filename in self.hashed else REVALIDATE,
+                "Vary": "Accept-Encoding",
+            },
+        )
+
+
+@fast_path
+async def static_handler(request: web.Request) -> web.StreamResponse:
+    return request.app[STATIC_ASSETS_KEY].response(request.match_info["filename"])
+
+
+def static_url(app: web.Application, filename: str) -> str:
+    """Where a file from static/ ends up, e.g. `js/notes.js`"""
+    return app[STATIC_ASSETS_KEY].url(filename)
+
+
+def setup_static(app: web.Application) -> None:
+    app[STATIC_ASSETS_KEY] = StaticAssets(STATIC_DIR, rescan=app["dev"])
+    app.router.add_get("/static/{filename:.+}", compile_handler(static_handler, "GET"), name="static")
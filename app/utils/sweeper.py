@@ -0,0 +1,77 @@
+"""Deletes expired sessions in the background instead of on every login"""
+
+import asyncio
+from contextlib import suppress
+from time import perf_counter
+from typing import Any
+
+import sentry_sdk
+from aiohttp import web
+
+from app.utils.db import delete_expired_sessions, get_db
+
+SESSION_SWEEPER_KEY = "session_sweeper"
+
+
+class SessionSweeper:
+    def __init__(self, app: web.Application, *, interval: float, batch_size: int) -> None:
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.runs = 0
+        self.purged = 0
+        self.last_purged = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+
+    async def sweep(self) -> int:
+        start = perf_counter()
+        purged = 0
+        # small batches keep each delete's locks short, other workers sweeping at the same time skip the rows
+        # this one has locked
+        while True:
+            deleted = await delete_expired_sessions(get_db(self.app), limit=self.batch_size)
+            purged += deleted
+            if deleted < self.batch_size:
+                break
+
+        duration = perf_counter() - start
+        self.runs += 1
+        self.purged += purged
+        self.last_purged = purged
+        self.last_duration = duration
+        self.total_duration += duration
+        return purged
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:  # pylint: disable=broad-except
+                sentry_sdk.capture_exception()
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "runs": f"{self.runs:,}",
+            "purged": f"{self.purged:,}",
+            "last_purged": f"{self.last_purged:,}",
+            "last_duration": f"{self.last_duration * 1000:,.2f} ms",
+            "average_duration": f"{self.total_duration / self.runs * 1000 if self.runs else 0:,.2f} ms",
+        }
+
+
+def setup_session_sweeper(app: web.Application) -> None:
+    config = app["config"].get("session_sweeper", {})
+    sweeper = SessionSweeper(app, interval=config.get("interval", 300), batch_size=config.get("batch_size", 1000))
+    app[SESSION_SWEEPER_KEY] = sweeper
+
+    task = asyncio.create_task(sweeper.run())
+
+    async def close(_: web.Application) -> None:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    app.on_cleanup.append(close)
@@ -0,0 +1,39 @@
+"""Memoized User-Agent parsing
+
+ua_parser runs a long list of regexes per string, but the same few browser builds make up nearly every request
+"""
+
+from typing import NamedTuple
+
+from aiohttp import web
+from ua_parser import user_agent_parser
+
+from app.utils.cache import LRUCache, register_cache
+
+USER_AGENT_CACHE_KEY = "user_agent_cache"
+
+
+class UserAgent(NamedTuple):
+    browser: str
+    os: str
+
+
+def parse_user_agent(app: web.Application, user_agent: str) -> UserAgent:
+    cache: LRUCache[str, UserAgent] = app[USER_AGENT_CACHE_KEY]
+
+    parsed = cache.get(user_agent)
+    if parsed is None:
+        # only the families are used, so the device regexes that Parse would also run are skipped
+        parsed = UserAgent(
+            user_agent_parser.ParseUserAgent(user_agent)["family"],
+            user_agent_parser.ParseOS(user_agent)["family"],
+        )
+        cache.set(user_agent, parsed)
+
+    return parsed
+
+
+def setup_user_agent_cache(app: web.Application) -> None:
+    # parsing a given string always gives the same result, so entries never expire
+    size = app["config"].get("cache", {}).get("user_agents", {}).get("size", 1000)
+    app[USER_AGENT_CACHE_KEY] = register_cache(app, "user_agents", LRUCache(maxsize=size))
@@ -0,0 +1,25 @@
+CREATE TABLE IF NOT EXISTS click_events (
+    alias TEXT NOT NULL,
+    clicked TIMESTAMP WITH TIME ZONE NOT NULL
+) PARTITION BY RANGE (clicked);
+
+CREATE TABLE IF NOT EXISTS click_rollups_hourly (
+    alias TEXT NOT NULL REFERENCES urls (alias) ON DELETE CASCADE ON UPDATE CASCADE,
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    clicks BIGINT NOT NULL,
+    PRIMARY KEY (alias, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS click_rollups_hourly_bucket_idx ON click_rollups_hourly (bucket);
+
+CREATE TABLE IF NOT EXISTS click_rollups_daily (
+    alias TEXT NOT NULL REFERENCES urls (alias) ON DELETE CASCADE ON UPDATE CASCADE,
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    clicks BIGINT NOT NULL,
+    PRIMARY KEY (alias, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS click_rollup_state (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    rolled_until TIMESTAMP WITH TIME ZONE NOT NULL
+);
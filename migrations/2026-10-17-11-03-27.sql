@@ -0,0 +1,26 @@
+UPDATE notes SET has_password = false WHERE has_password IS NULL;
+UPDATE notes SET share_email = true WHERE share_email IS NULL;
+UPDATE notes SET private = false WHERE private IS NULL;
+
+ALTER TABLE notes
+    ALTER COLUMN has_password SET NOT NULL,
+    ALTER COLUMN share_email SET NOT NULL,
+    ALTER COLUMN private SET NOT NULL;
+
+ALTER TABLE users
+    ALTER COLUMN email SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS urls_owner_alias_idx ON urls (owner, alias);
+CREATE INDEX IF NOT EXISTS urls_owner_clicks_idx ON urls (owner, clicks, alias);
+CREATE INDEX IF NOT EXISTS urls_owner_creation_date_idx ON urls (owner, creation_date, alias);
+
+CREATE INDEX IF NOT EXISTS notes_owner_id_idx ON notes (owner, id);
+CREATE INDEX IF NOT EXISTS notes_owner_name_idx ON notes (owner, name, id);
+CREATE INDEX IF NOT EXISTS notes_owner_has_password_idx ON notes (owner, has_password, id);
+CREATE INDEX IF NOT EXISTS notes_owner_share_email_idx ON notes (owner, share_email, id);
+CREATE INDEX IF NOT EXISTS notes_owner_private_idx ON notes (owner, private, id);
+CREATE INDEX IF NOT EXISTS notes_owner_clicks_idx ON notes (owner, clicks, id);
+CREATE INDEX IF NOT EXISTS notes_owner_creation_date_idx ON notes (owner, creation_date, id);
+
+CREATE INDEX IF NOT EXISTS users_email_id_idx ON users (email, id);
+CREATE INDEX IF NOT EXISTS users_joined_id_idx ON users (joined, id);
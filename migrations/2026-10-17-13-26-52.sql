@@ -0,0 +1,109 @@
+-- row counts kept up to date by triggers so pages don't have to count(*) the tables
+-- owner 0 is the total for the whole table, users start at 1
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL,
+    owner BIGINT NOT NULL DEFAULT 0,
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, owner)
+);
+
+INSERT INTO counters (name) VALUES ('users'), ('urls'), ('notes'), ('sessions') ON CONFLICT DO NOTHING;
+
+-- TG_ARGV[0] is the counter name, TG_ARGV[1] the column with the owning user
+CREATE OR REPLACE FUNCTION count_owned_rows() RETURNS TRIGGER AS $$
+DECLARE
+    delta BIGINT := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    -- the total is always locked first so concurrent writers can't deadlock on the per owner rows
+    UPDATE counters SET value = value + delta * (SELECT count(*) FROM changed) WHERE name = TG_ARGV[0] AND owner = 0;
+    -- per owner rows only exist while the user does, so rows cascading from a deleted user are a no-op
+    EXECUTE format(
+        'UPDATE counters SET value = counters.value + $1 * changed.count
+        FROM (SELECT %I AS owner, count(*) AS count FROM changed GROUP BY %I) changed
+        WHERE counters.name = $2 AND counters.owner = changed.owner',
+        TG_ARGV[1], TG_ARGV[1]
+    ) USING delta, TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_users() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE counters SET value = value + (SELECT count(*) FROM changed) WHERE name = 'users' AND owner = 0;
+        INSERT INTO counters (name, owner)
+            SELECT counter.name, changed.id FROM changed CROSS JOIN (VALUES ('urls'), ('notes'), ('sessions')) counter(name)
+            ON CONFLICT DO NOTHING;
+    ELSE
+        UPDATE counters SET value = value - (SELECT count(*) FROM changed) WHERE name = 'users' AND owner = 0;
+        DELETE FROM counters WHERE owner IN (SELECT id FROM changed);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- recounts everything and returns the counters that had drifted
+CREATE OR REPLACE FUNCTION rebuild_counters() RETURNS TABLE (name TEXT, owner BIGINT, stored BIGINT, actual BIGINT) AS $$
+    LOCK TABLE users, urls, notes, sessions IN SHARE MODE;
+
+    WITH actual AS (
+        SELECT 'users' AS name, 0::BIGINT AS owner, count(*) AS value FROM users
+        UNION ALL SELECT 'urls', 0, count(*) FROM urls
+        UNION ALL SELECT 'notes', 0, count(*) FROM notes
+        UNION ALL SELECT 'sessions', 0, count(*) FROM sessions
+        UNION ALL
+        SELECT counter.name, users.id, coalesce(owned.value, 0)
+        FROM users
+        CROSS JOIN (VALUES ('urls'), ('notes'), ('sessions')) counter(name)
+        LEFT JOIN (
+            SELECT 'urls' AS name, owner, count(*) AS value FROM urls GROUP BY owner
+            UNION ALL SELECT 'notes', owner, count(*) FROM notes GROUP BY owner
+            UNION ALL SELECT 'sessions', user_id, count(*) FROM sessions GROUP BY user_id
+        ) owned ON owned.name = counter.name AND owned.owner = users.id
+    ),
+    removed AS (
+        DELETE FROM counters WHERE NOT EXISTS (
+            SELECT 1 FROM actual WHERE actual.name = counters.name AND actual.owner = counters.owner
+        )
+    ),
+    fixed AS (
+        INSERT INTO counters (name, owner, value) SELECT name, owner, value FROM actual
+        ON CONFLICT (name, owner) DO UPDATE SET value = EXCLUDED.value WHERE counters.value <> EXCLUDED.value
+    )
+    SELECT coalesce(actual.name, counters.name), coalesce(actual.owner, counters.owner), counters.value, actual.value
+    FROM actual
+    FULL JOIN counters ON counters.name = actual.name AND counters.owner = actual.owner
+    WHERE counters.value IS DISTINCT FROM actual.value
+    ORDER BY 1, 2;
+$$ LANGUAGE sql;
+
+DROP TRIGGER IF EXISTS usersCountInsert ON users;
+CREATE TRIGGER usersCountInsert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_users();
+DROP TRIGGER IF EXISTS usersCountDelete ON users;
+CREATE TRIGGER usersCountDelete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_users();
+
+-- owners never change, so updates don't need to be counted
+DROP TRIGGER IF EXISTS urlsCountInsert ON urls;
+CREATE TRIGGER urlsCountInsert AFTER INSERT ON urls
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('urls', 'owner');
+DROP TRIGGER IF EXISTS urlsCountDelete ON urls;
+CREATE TRIGGER urlsCountDelete AFTER DELETE ON urls
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('urls', 'owner');
+
+DROP TRIGGER IF EXISTS notesCountInsert ON notes;
+CREATE TRIGGER notesCountInsert AFTER INSERT ON notes
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('notes', 'owner');
+DROP TRIGGER IF EXISTS notesCountDelete ON notes;
+CREATE TRIGGER notesCountDelete AFTER DELETE ON notes
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('notes', 'owner');
+
+DROP TRIGGER IF EXISTS sessionsCountInsert ON sessions;
+CREATE TRIGGER sessionsCountInsert AFTER INSERT ON sessions
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('sessions', 'user_id');
+DROP TRIGGER IF EXISTS sessionsCountDelete ON sessions;
+CREATE TRIGGER sessionsCountDelete AFTER DELETE ON sessions
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('sessions', 'user_id');
+
+SELECT * FROM rebuild_counters();
@@ -0,0 +1,3 @@
+ALTER TABLE users ADD COLUMN IF NOT EXISTS api_key_digest BYTEA;
+UPDATE users SET api_key_digest = sha256(convert_to(api_key, 'UTF8')) WHERE api_key IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS users_api_key_digest_idx ON users (api_key_digest);
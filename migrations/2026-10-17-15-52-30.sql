@@ -0,0 +1,21 @@
+-- deleted sessions that hadn't expired yet, signed session cookies can't be taken back so workers check these
+CREATE TABLE IF NOT EXISTS revoked_sessions (
+    token UUID NOT NULL PRIMARY KEY,
+    expires TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION revoke_sessions() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM revoked_sessions WHERE expires <= now();
+    INSERT INTO revoked_sessions (token, expires)
+        SELECT token, expires FROM changed WHERE expires > now()
+        ON CONFLICT DO NOTHING;
+    -- also how every worker's session cache hears about it, including sessions deleted by a user deletion cascade
+    PERFORM pg_notify('session_invalidate', 'token:' || token) FROM changed WHERE expires > now();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sessionsRevoke ON sessions;
+CREATE TRIGGER sessionsRevoke AFTER DELETE ON sessions
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE revoke_sessions();
@@ -0,0 +1,4 @@
+DROP TRIGGER IF EXISTS oldSessionsExpiry ON sessions;
+DROP FUNCTION IF EXISTS deleteOldSessions();
+
+CREATE INDEX IF NOT EXISTS sessions_expires_idx ON sessions (expires);
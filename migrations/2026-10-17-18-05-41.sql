@@ -0,0 +1,22 @@
+-- every worker keeps a version per owner that its cached pages are keyed on, see FragmentCache in app/templating.py
+-- updates don't change anything those pages show, and clicks update urls constantly, so only inserts and deletes bump it
+CREATE OR REPLACE FUNCTION notify_data_version() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('data_version', owner::TEXT) FROM (SELECT DISTINCT owner FROM changed) owners;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS urlsVersionInsert ON urls;
+CREATE TRIGGER urlsVersionInsert AFTER INSERT ON urls
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
+DROP TRIGGER IF EXISTS urlsVersionDelete ON urls;
+CREATE TRIGGER urlsVersionDelete AFTER DELETE ON urls
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
+
+DROP TRIGGER IF EXISTS notesVersionInsert ON notes;
+CREATE TRIGGER notesVersionInsert AFTER INSERT ON notes
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
+DROP TRIGGER IF EXISTS notesVersionDelete ON notes;
+CREATE TRIGGER notesVersionDelete AFTER DELETE ON notes
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
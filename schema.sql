@@ -1,8 +1,10 @@
 CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
-    email TEXT UNIQUE,
+    email TEXT NOT NULL UNIQUE,
     password TEXT,
     api_key TEXT,
+    -- sha256 of api_key, what api keys are looked up by
+    api_key_digest BYTEA,
     session_duration BIGINT NOT NULL DEFAULT 86400,
 	admin BOOLEAN DEFAULT false,
     joined TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC')
@@ -31,13 +33,32 @@ CREATE TABLE IF NOT EXISTS notes (
     owner BIGINT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
     name TEXT NOT NULL,
     content BYTEA NOT NULL,
-    has_password BOOLEAN DEFAULT false,
-    share_email BOOLEAN DEFAULT True,
-    private BOOLEAN DEFAULT false,
+    has_password BOOLEAN NOT NULL DEFAULT false,
+    share_email BOOLEAN NOT NULL DEFAULT True,
+    private BOOLEAN NOT NULL DEFAULT false,
     clicks BIGINT DEFAULT 0 NOT NULL,
     creation_date TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC')
 );
 
+-- keyset pagination, one index per sortable column with the primary key as tiebreaker
+-- destination has no length limit so it can't safely be put in a btree index, sorting by it uses urls_owner_alias_idx
+CREATE INDEX IF NOT EXISTS urls_owner_alias_idx ON urls (owner, alias);
+CREATE INDEX IF NOT EXISTS urls_owner_clicks_idx ON urls (owner, clicks, alias);
+CREATE INDEX IF NOT EXISTS urls_owner_creation_date_idx ON urls (owner, creation_date, alias);
+
+CREATE INDEX IF NOT EXISTS notes_owner_id_idx ON notes (owner, id);
+CREATE INDEX IF NOT EXISTS notes_owner_name_idx ON notes (owner, name, id);
+CREATE INDEX IF NOT EXISTS notes_owner_has_password_idx ON notes (owner, has_password, id);
+CREATE INDEX IF NOT EXISTS notes_owner_share_email_idx ON notes (owner, share_email, id);
+CREATE INDEX IF NOT EXISTS notes_owner_private_idx ON notes (owner, private, id);
+CREATE INDEX IF NOT EXISTS notes_owner_clicks_idx ON notes (owner, clicks, id);
+CREATE INDEX IF NOT EXISTS notes_owner_creation_date_idx ON notes (owner, creation_date, id);
+
+CREATE INDEX IF NOT EXISTS users_email_id_idx ON users (email, id);
+CREATE INDEX IF NOT EXISTS users_joined_id_idx ON users (joined, id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_api_key_digest_idx ON users (api_key_digest);
+
 CREATE TABLE IF NOT EXISTS invites (
     code UUID NOT NULL PRIMARY KEY DEFAULT (gen_random_uuid()),
     owner BIGINT REFERENCES users (id) ON DELETE CASCADE,
@@ -46,16 +67,184 @@ CREATE TABLE IF NOT EXISTS invites (
     creation_date TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC')
 );
 
-CREATE OR REPLACE FUNCTION deleteOldSessions() RETURNS TRIGGER AS $$
+CREATE TABLE IF NOT EXISTS click_events (
+    alias TEXT NOT NULL,
+    clicked TIMESTAMP WITH TIME ZONE NOT NULL
+) PARTITION BY RANGE (clicked);
+
+CREATE TABLE IF NOT EXISTS click_rollups_hourly (
+    alias TEXT NOT NULL REFERENCES urls (alias) ON DELETE CASCADE ON UPDATE CASCADE,
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    clicks BIGINT NOT NULL,
+    PRIMARY KEY (alias, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS click_rollups_hourly_bucket_idx ON click_rollups_hourly (bucket);
+
+CREATE TABLE IF NOT EXISTS click_rollups_daily (
+    alias TEXT NOT NULL REFERENCES urls (alias) ON DELETE CASCADE ON UPDATE CASCADE,
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    clicks BIGINT NOT NULL,
+    PRIMARY KEY (alias, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS click_rollup_state (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    rolled_until TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- row counts kept up to date by triggers so pages don't have to count(*) the tables
+-- owner 0 is the total for the whole table, users start at 1
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL,
+    owner BIGINT NOT NULL DEFAULT 0,
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, owner)
+);
+
+INSERT INTO counters (name) VALUES ('users'), ('urls'), ('notes'), ('sessions') ON CONFLICT DO NOTHING;
+
+-- TG_ARGV[0] is the counter name, TG_ARGV[1] the column with the owning user
+CREATE OR REPLACE FUNCTION count_owned_rows() RETURNS TRIGGER AS $$
+DECLARE
+    delta BIGINT := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    -- the total is always locked first so concurrent writers can't deadlock on the per owner rows
+    UPDATE counters SET value = value + delta * (SELECT count(*) FROM changed) WHERE name = TG_ARGV[0] AND owner = 0;
+    -- per owner rows only exist while the user does, so rows cascading from a deleted user are a no-op
+    EXECUTE format(
+        'UPDATE counters SET value = counters.value + $1 * changed.count
+        FROM (SELECT %I AS owner, count(*) AS count FROM changed GROUP BY %I) changed
+        WHERE counters.name = $2 AND counters.owner = changed.owner',
+        TG_ARGV[1], TG_ARGV[1]
+    ) USING delta, TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_users() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE counters SET value = value + (SELECT count(*) FROM changed) WHERE name = 'users' AND owner = 0;
+        INSERT INTO counters (name, owner)
+            SELECT counter.name, changed.id FROM changed CROSS JOIN (VALUES ('urls'), ('notes'), ('sessions')) counter(name)
+            ON CONFLICT DO NOTHING;
+    ELSE
+        UPDATE counters SET value = value - (SELECT count(*) FROM changed) WHERE name = 'users' AND owner = 0;
+        DELETE FROM counters WHERE owner IN (SELECT id FROM changed);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- recounts everything and returns the counters that had drifted
+CREATE OR REPLACE FUNCTION rebuild_counters() RETURNS TABLE (name TEXT, owner BIGINT, stored BIGINT, actual BIGINT) AS $$
+    LOCK TABLE users, urls, notes, sessions IN SHARE MODE;
+
+    WITH actual AS (
+        SELECT 'users' AS name, 0::BIGINT AS owner, count(*) AS value FROM users
+        UNION ALL SELECT 'urls', 0, count(*) FROM urls
+        UNION ALL SELECT 'notes', 0, count(*) FROM notes
+        UNION ALL SELECT 'sessions', 0, count(*) FROM sessions
+        UNION ALL
+        SELECT counter.name, users.id, coalesce(owned.value, 0)
+        FROM users
+        CROSS JOIN (VALUES ('urls'), ('notes'), ('sessions')) counter(name)
+        LEFT JOIN (
+            SELECT 'urls' AS name, owner, count(*) AS value FROM urls GROUP BY owner
+            UNION ALL SELECT 'notes', owner, count(*) FROM notes GROUP BY owner
+            UNION ALL SELECT 'sessions', user_id, count(*) FROM sessions GROUP BY user_id
+        ) owned ON owned.name = counter.name AND owned.owner = users.id
+    ),
+    removed AS (
+        DELETE FROM counters WHERE NOT EXISTS (
+            SELECT 1 FROM actual WHERE actual.name = counters.name AND actual.owner = counters.owner
+        )
+    ),
+    fixed AS (
+        INSERT INTO counters (name, owner, value) SELECT name, owner, value FROM actual
+        ON CONFLICT (name, owner) DO UPDATE SET value = EXCLUDED.value WHERE counters.value <> EXCLUDED.value
+    )
+    SELECT coalesce(actual.name, counters.name), coalesce(actual.owner, counters.owner), counters.value, actual.value
+    FROM actual
+    FULL JOIN counters ON counters.name = actual.name AND counters.owner = actual.owner
+    WHERE counters.value IS DISTINCT FROM actual.value
+    ORDER BY 1, 2;
+$$ LANGUAGE sql;
+
+DROP TRIGGER IF EXISTS usersCountInsert ON users;
+CREATE TRIGGER usersCountInsert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_users();
+DROP TRIGGER IF EXISTS usersCountDelete ON users;
+CREATE TRIGGER usersCountDelete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_users();
+
+-- owners never change, so updates don't need to be counted
+DROP TRIGGER IF EXISTS urlsCountInsert ON urls;
+CREATE TRIGGER urlsCountInsert AFTER INSERT ON urls
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('urls', 'owner');
+DROP TRIGGER IF EXISTS urlsCountDelete ON urls;
+CREATE TRIGGER urlsCountDelete AFTER DELETE ON urls
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('urls', 'owner');
+
+DROP TRIGGER IF EXISTS notesCountInsert ON notes;
+CREATE TRIGGER notesCountInsert AFTER INSERT ON notes
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('notes', 'owner');
+DROP TRIGGER IF EXISTS notesCountDelete ON notes;
+CREATE TRIGGER notesCountDelete AFTER DELETE ON notes
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('notes', 'owner');
+
+DROP TRIGGER IF EXISTS sessionsCountInsert ON sessions;
+CREATE TRIGGER sessionsCountInsert AFTER INSERT ON sessions
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('sessions', 'user_id');
+DROP TRIGGER IF EXISTS sessionsCountDelete ON sessions;
+CREATE TRIGGER sessionsCountDelete AFTER DELETE ON sessions
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE count_owned_rows('sessions', 'user_id');
+
+-- deleted sessions that hadn't expired yet, signed session cookies can't be taken back so workers check these
+CREATE TABLE IF NOT EXISTS revoked_sessions (
+    token UUID NOT NULL PRIMARY KEY,
+    expires TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION revoke_sessions() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM revoked_sessions WHERE expires <= now();
+    INSERT INTO revoked_sessions (token, expires)
+        SELECT token, expires FROM changed WHERE expires > now()
+        ON CONFLICT DO NOTHING;
+    -- also how every worker's session cache hears about it, including sessions deleted by a user deletion cascade
+    PERFORM pg_notify('session_invalidate', 'token:' || token) FROM changed WHERE expires > now();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sessionsRevoke ON sessions;
+CREATE TRIGGER sessionsRevoke AFTER DELETE ON sessions
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE revoke_sessions();
+
+-- expired sessions are deleted in batches by app/utils/sweeper.py
+CREATE INDEX IF NOT EXISTS sessions_expires_idx ON sessions (expires);
+
+-- every worker keeps a version per owner that its cached pages are keyed on, see FragmentCache in app/templating.py
+-- updates don't change anything those pages show, and clicks update urls constantly, so only inserts and deletes bump it
+CREATE OR REPLACE FUNCTION notify_data_version() RETURNS TRIGGER AS $$
 BEGIN
-    DELETE FROM sessions CASCADE WHERE expires IS NOT NULL AND expires < now() AT TIME ZONE 'utc';
-    RETURN NEW;
+    PERFORM pg_notify('data_version', owner::TEXT) FROM (SELECT DISTINCT owner FROM changed) owners;
+    RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
-DROP TRIGGER IF EXISTS oldSessionsExpiry on public.sessions;
-CREATE TRIGGER oldSessionsExpiry
-    AFTER INSERT OR UPDATE
-    ON sessions
-    FOR STATEMENT
-    EXECUTE PROCEDURE deleteOldSessions();
+DROP TRIGGER IF EXISTS urlsVersionInsert ON urls;
+CREATE TRIGGER urlsVersionInsert AFTER INSERT ON urls
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
+DROP TRIGGER IF EXISTS urlsVersionDelete ON urls;
+CREATE TRIGGER urlsVersionDelete AFTER DELETE ON urls
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
+
+DROP TRIGGER IF EXISTS notesVersionInsert ON notes;
+CREATE TRIGGER notesVersionInsert AFTER INSERT ON notes
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
+DROP TRIGGER IF EXISTS notesVersionDelete ON notes;
+CREATE TRIGGER notesVersionDelete AFTER DELETE ON notes
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_version();
@@ -8,11 +8,11 @@ sys.path.append(os.getcwd())  # weird python module resolution but this works so
 
 
 from asyncpg import UniqueViolationError, create_pool
-from passlib.hash import pbkdf2_sha512
 from yaml import safe_load
 
 from app.utils.auth import generate_api_key
 from app.utils.db import insert_user
+from app.utils.passwords import DEFAULT_ROUNDS, password_handler
 
 
 async def main():
@@ -42,7 +42,8 @@ async def main():
 
     del password_confirmation
 
-    pw_hash = pbkdf2_sha512.hash(password)
+    # nothing else is waiting on this process, so there's no need for the hasher's process pool
+    pw_hash = password_handler(config.get("passwords", {}).get("rounds", DEFAULT_ROUNDS)).hash(password)
 
     pool = await create_pool(config["postgres_dsn"])
     try:
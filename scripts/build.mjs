@@ -1,5 +1,7 @@
 import esbuild from "esbuild";
 import fs from "fs"
+import path from "path"
+import zlib from "zlib"
 
 let all = [];
 
@@ -11,12 +13,60 @@ fs.readdirSync("./static/css").forEach(f => {
     all.push("static/css/" + f)
 });
 
-await esbuild.build({
+// hashed names from an older build would otherwise pile up
+fs.rmSync("dist", { recursive: true, force: true });
+
+const result = await esbuild.build({
     entryPoints: all,
     outdir: "dist",
+    outbase: "static",
+    // the hash in the name is what lets app/utils/static.py tell browsers to cache these forever
+    entryNames: "[dir]/[name]-[hash]",
+    metafile: true,
     bundle: true,
     minify: true,
     format: "esm",
     logLevel: "debug",
     platform: "browser",
 })
+
+// name templates ask for -> hashed name, e.g. "js/notes.js" -> "js/notes-4XJ2KQ3A.js" for static/js/notes.ts.
+// keyed on the output extension, templates link the built .js and never the .ts it came from
+let manifest = {};
+
+for (const [output, meta] of Object.entries(result.metafile.outputs)) {
+    if (meta.entryPoint === undefined) {
+        continue
+    }
+    const source = path.parse(path.relative("static", meta.entryPoint));
+    manifest[path.posix.join(source.dir, source.name + path.extname(output))] = path.relative("dist", output);
+
+    // served in place of the original to clients that accept them, so nothing gets compressed per request
+    const contents = fs.readFileSync(output);
+    fs.writeFileSync(output + ".gz", zlib.gzipSync(contents, { level: 9 }));
+    fs.writeFileSync(output + ".br", zlib.brotliCompressSync(contents, {
+        params: { [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY },
+    }));
+}
+
+fs.writeFileSync("dist/manifest.json", JSON.stringify(manifest, null, 2) + "\n");
+
+// a template linking a file the build didn't produce would 404, dist is wiped above so nothing stale covers for it
+const staticUrl = /url_for\(\s*["']static["']\s*,\s*filename\s*=\s*["']([^"']+)["']\s*\)/g;
+let missing = [];
+
+for (const file of fs.readdirSync("templates", { recursive: true })) {
+    if (!file.endsWith(".jinja")) {
+        continue
+    }
+    for (const match of fs.readFileSync(path.join("templates", file), "utf8").matchAll(staticUrl)) {
+        if (!(match[1] in manifest)) {
+            missing.push(`templates/${file}: ${match[1]}`)
+        }
+    }
+}
+
+if (missing.length > 0) {
+    console.error("templates link static files missing from dist/manifest.json:\n" + missing.join("\n"));
+    process.exit(1);
+}
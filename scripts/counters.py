@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.append(os.getcwd())  # weird python module resolution but this works so idk
+
+
+from asyncpg import connect
+from yaml import safe_load
+
+from app.utils.db import rebuild_counters
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Recount the users, urls, notes and sessions counters")
+    parser.add_argument("-p", "--prod", "--production", action="store_true", dest="production")
+    parser.add_argument("--dry-run", action="store_true", help="only show the counters that drifted")
+
+    args = parser.parse_args()
+
+    with open("config.yml", encoding="utf-8") as file:
+        loaded = safe_load(file)
+
+    if args.production:
+        config = loaded["prod"]
+    else:
+        config = loaded["dev"]
+
+    conn = await connect(config["postgres_dsn"])
+    try:
+        # writes to the counted tables wait until this is done
+        transaction = conn.transaction()
+        await transaction.start()
+        drifted = await rebuild_counters(conn)
+        if args.dry_run:
+            await transaction.rollback()
+        else:
+            await transaction.commit()
+    finally:
+        await conn.close()
+
+    if not drifted:
+        print("All counters are correct")
+        return
+
+    for counter in drifted:
+        owner = "total" if counter["owner"] == 0 else f"user {counter['owner']}"
+        print(f"{counter['name']} ({owner}): {counter['stored']} -> {counter['actual']}")
+
+    print(f"{'Found' if args.dry_run else 'Fixed'} {len(drifted)} drifted counters")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
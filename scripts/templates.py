@@ -0,0 +1,22 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.getcwd())  # weird python module resolution but this works so idk
+
+
+from app.templating import COMPILED_TEMPLATES_DIR, compile_templates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompile the jinja templates into python modules")
+    parser.add_argument("-o", "--output", default=COMPILED_TEMPLATES_DIR)
+
+    args = parser.parse_args()
+
+    compile_templates(args.output)
+    print(f"compiled templates into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
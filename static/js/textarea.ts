@@ -0,0 +1,7 @@
+for (const textarea of document.getElementsByTagName("textarea")) {
+    textarea.addEventListener("input", () => {
+        textarea.style.height = "auto"
+        textarea.style.height = textarea.scrollHeight + "px"
+        textarea.style.maxHeight = textarea.style.height
+    })
+}